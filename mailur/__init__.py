@@ -22,6 +22,8 @@ conf = {
     'USE_PROXY': os.environ.get('MLR_USE_PROXY', False),
     'IMAP_OFF': os.environ.get('MLR_IMAP_OFF', '').split(),
     'GMAIL_TWO_WAY_SYNC': os.environ.get('MLR_GMAIL_TWO_WAY_SYNC', False),
+    'CACHE_DIR': os.environ.get('MLR_CACHE_DIR', ''),
+    'CACHE_MB': int(os.environ.get('MLR_CACHE_MB', 512)),
 }
 
 
@@ -1,29 +1,135 @@
-from . import conf
+import marshal
+import mmap
+import pathlib
+import shutil
+import sys
+import uuid
+from collections import OrderedDict
 
-store = {}
+from . import conf, log
+
+store = OrderedDict()
+sizes = {}
+stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0}
 
 
 def key(name):
     return conf['USER'], name
 
 
+def sizeof(value):
+    """Rough size of the value: containers are counted one level deep"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(sys.getsizeof(i) for i in value)
+    return size
+
+
 def get(name, default=None):
-    return store.get(key(name), default)
+    k = key(name)
+    if k not in store:
+        stats['misses'] += 1
+        return default
+
+    stats['hits'] += 1
+    store.move_to_end(k)
+    return store[k]
+
 
+def set(name, value, size=None):
+    """Save value, least recently used values are evicted over "CACHE_MB"
 
-def set(name, value):
-    store[key(name)] = value
+    "size" in bytes is estimated by "sizeof" if it is not provided.
+    """
+    k = key(name)
+    rm(name)
+    store[k] = value
+    sizes[k] = sizeof(value) if size is None else size
+    stats['size'] += sizes[k]
+
+    limit = conf['CACHE_MB'] * 2 ** 20
+    while limit and stats['size'] > limit and len(store) > 1:
+        old = next(iter(store))
+        if old == k:
+            break
+        log.debug('cache: evict %s:%s', *old)
+        stats['evictions'] += 1
+        stats['size'] -= sizes.pop(old)
+        del store[old]
 
 
 def rm(name):
-    store.pop(key(name), None)
+    k = key(name)
+    store.pop(k, None)
+    stats['size'] -= sizes.pop(k, 0)
 
 
 def clear():
     for key in list(store.keys()):
         if key[0] == conf['USER']:
             del store[key]
+            stats['size'] -= sizes.pop(key)
 
 
 def exists(name):
     return key(name) in store
+
+
+def usage():
+    """Counters and cached bytes per user to size workers"""
+    users = {}
+    for (user, name), size in sizes.items():
+        users[user] = users.get(user, 0) + size
+    return dict(stats, users=users)
+
+
+def shared_path(name):
+    return pathlib.Path(conf['CACHE_DIR'], conf['USER'], name)
+
+
+def shared_get(name, default=None):
+    """Value shared between processes via memory-mapped file
+
+    Works only if "MLR_CACHE_DIR" is set.
+    """
+    if not conf['CACHE_DIR']:
+        return default
+
+    try:
+        with shared_path(name).open('rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return marshal.loads(mm)
+    except FileNotFoundError:
+        return default
+    except (ValueError, EOFError, TypeError) as e:
+        log.warning('shared cache %r is broken: %r', name, e)
+        return default
+
+
+def shared_set(name, value):
+    if not conf['CACHE_DIR']:
+        return
+
+    path = shared_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.%s.%s' % (path.name, uuid.uuid4().hex))
+    try:
+        tmp.write_bytes(marshal.dumps(value))
+    except ValueError as e:
+        log.warning('shared cache %r is not saved: %r', name, e)
+        return
+    tmp.replace(path)
+
+
+def shared_clean(name, keep=()):
+    """Remove shared values in "name" directory except "keep" ones"""
+    if not conf['CACHE_DIR']:
+        return
+
+    path = shared_path(name)
+    if not path.is_dir():
+        return
+    for i in path.iterdir():
+        if i.name not in keep:
+            log.info('shared cache: remove %s', i)
+            shutil.rmtree(i, ignore_errors=True)
@@ -65,6 +65,9 @@ def build_parser(args):
         .arg('criteria', nargs='?')\
         .arg('--batch', type=int, default=1000, help='batch size')\
         .arg('--threads', type=int, default=2, help='thread pool size')\
+        .arg('--procs', type=int, help='parse in process pool of this size')\
+        .arg('--max-inflight-mb', type=int, help='memory limit for messages')\
+        .arg('--stale', action='store_true', help='only outdated messages')\
         .arg('--fix-duplicates', action='store_true')
 
     cmd('metadata')\
@@ -117,7 +120,11 @@ def process(args):
         opts = dict(threads=args.threads, batch=args.batch)
         if args.fix_duplicates:
             local.clean_duplicate_msgs()
-        local.parse(args.criteria, **opts)
+        opts.update(procs=args.procs, inflight_mb=args.max_inflight_mb)
+        if args.stale:
+            local.parse_stale(**opts)
+        else:
+            local.parse(args.criteria, **opts)
     elif args.cmd == 'metadata':
         local.update_metadata(args.uids)
 
@@ -25,20 +25,27 @@ renderer = HighlightRenderer(escape=False, hard_wrap=True)
 markdown = mistune.Markdown(renderer=renderer)
 
 
+# the same cleaner for all messages
+cleaner = Cleaner(
+    links=False,
+    style=True,
+    inline_style=False,
+    kill_tags=['head'],
+    remove_tags=['html', 'base'],
+    safe_attrs=list(set(Cleaner.safe_attrs) - {'class'}) + ['style'],
+)
+
+
 def clean(htm, embeds=None):
+    """Cleaned html, flags of richer content and text (for preview)
+
+    The html is parsed only once for all of them.
+    """
     htm = re.sub(r'^\s*<\?xml.*?\?>', '', htm).strip()
     if not htm:
-        return '', {}
+        return '', {}, ''
 
     htm = htm.replace('\r\n', '\n')
-    cleaner = Cleaner(
-        links=False,
-        style=True,
-        inline_style=False,
-        kill_tags=['head'],
-        remove_tags=['html', 'base'],
-        safe_attrs=list(set(Cleaner.safe_attrs) - {'class'}) + ['style'],
-    )
     htm = fromstring(htm)
     htm = cleaner.clean_html(htm)
 
@@ -67,12 +74,18 @@ def clean(htm, embeds=None):
     richer = (('styles', styles), ('ext_images', ext_images))
     richer = {k: v for k, v in richer if v}
 
+    txt = to_text(htm)
     htm = tostring(htm, encoding='unicode').strip()
     htm = re.sub('(^<div>|</div>$)', '', htm)
-    return htm, richer
+    return htm, richer, txt
+
 
+def fix_privacy(htm, only_proxy=False, cleaned=False):
+    """Hide external images and styles (or use proxy for images)
 
-def fix_privacy(htm, only_proxy=False):
+    "cleaned" html is the result of "clean", so it isn't parsed again
+    if there are no images and styles.
+    """
     if not htm.strip():
         return htm
 
@@ -80,6 +93,10 @@ def fix_privacy(htm, only_proxy=False):
     if only_proxy and not use_proxy:
         return htm
 
+    pattern = r'<img\s' if only_proxy else r'<img\s|\sstyle='
+    if cleaned and not re.search(pattern, htm, re.I):
+        return htm
+
     htm = fromstring(htm)
     for img in htm.xpath('//img[@src]'):
         src = img.attrib['src']
@@ -132,11 +149,14 @@ def from_text(txt):
 
 
 def to_text(htm):
-    htm = fromstring(htm)
+    if isinstance(htm, str):
+        htm = fromstring(htm)
     return '\n'.join(escape(i) for i in htm.xpath('//text()') if i)
 
 
-def to_line(htm, limit=200):
-    txt = to_text(htm)
+def to_line(htm, limit=200, txt=None):
+    """One line of text, "txt" is used if it's got from "clean" already"""
+    if txt is None:
+        txt = to_text(htm)
     txt = re.sub(r'([\s ]|&nbsp;)+', ' ', txt)
     return txt[:limit]
@@ -1,6 +1,5 @@
 import functools as ft
 import inspect
-import json
 import re
 import time
 from contextlib import contextmanager
@@ -248,24 +247,72 @@ def _mdkey(key):
     return key
 
 
+def _mdvalue(value):
+    if value is None:
+        return 'NIL'
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return '"%s"' % value
+
+
+def parse_metadata(data):
+    """Entries of METADATA responses as dict"""
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            line, literal = item
+            line = re.sub(rb'\{\d+\}$', b'', line)
+            tokens.extend(re.findall(rb'"(?:\\.|[^"\\])*"|[^\s()"]+', line))
+            tokens.append([literal])
+        elif item:
+            tokens.extend(re.findall(rb'"(?:\\.|[^"\\])*"|[^\s()"]+', item))
+
+    entries = {}
+    key = None
+    for token in tokens:
+        if key is None:
+            if token.startswith(b'/'):
+                key = token.decode()
+            # otherwise it's a mailbox name
+            continue
+
+        if isinstance(token, list):
+            value = token[0].decode()
+        elif token == b'NIL':
+            value = None
+        elif token.startswith(b'"'):
+            value = re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode()
+        else:
+            value = token.decode()
+        entries[key] = value
+        key = None
+    return entries
+
+
 @command(dovecot=True, writable=True)
-def setmetadata(con, box, key, value):
-    key = _mdkey(key)
+def setmetadata(con, box, key, value=None):
+    """Set entry or entries if "key" is dict, "None" removes entry"""
+    entries = key if isinstance(key, dict) else {key: value}
+    entries = ' '.join(
+        '%s %s' % (_mdkey(k), _mdvalue(v)) for k, v in entries.items()
+    )
     with _cmd(con, 'SETMETADATA') as (tag, start, complete):
-        args = ' %s (%s %s)' % (box, key, json.dumps(value))
+        args = ' %s (%s)' % (box, entries)
         start(args.encode() + CRLF)
         typ, data = complete()
         return check(con._untagged_response(typ, data, 'METADATA'))
 
 
 @command(dovecot=True)
-def getmetadata(con, box, key):
+def getmetadata(con, box, key, depth=None):
     key = _mdkey(key)
+    opts = ' (DEPTH %s)' % depth if depth else ''
     with _cmd(con, 'GETMETADATA') as (tag, start, complete):
-        args = ' %s (%s)' % (box, key)
+        args = '%s %s (%s)' % (opts, box, key)
         start(args.encode() + CRLF)
         typ, data = complete()
-        return check(con._untagged_response(typ, data, 'METADATA'))
+        return parse_metadata(check(
+            con._untagged_response(typ, data, 'METADATA')
+        ))
 
 
 @command(dovecot=True)
@@ -359,6 +406,15 @@ def sort(con, fields, *criteria, charset='UTF-8'):
     return res[0].decode().split()
 
 
+@command(dovecot=True)
+def sort_partial(con, fields, criteria, first, last, charset='UTF-8'):
+    """Page of sorted uids and total count (ESORT with PARTIAL, RFC 5267)"""
+    ret = 'RETURN (PARTIAL %s:%s COUNT)' % (first, last)
+    check(con.uid('SORT', ret, fields, charset, criteria))
+    res = con.untagged_responses.pop('ESEARCH', [b''])
+    return parse_esearch(res[-1])
+
+
 @command()
 def idle(con, handlers, timeout=None):
     def match():
@@ -582,6 +638,36 @@ def pack_uids(uids):
     return result
 
 
+def unpack_uids(uids):
+    """Opposite of "pack_uids": "1,3:5" -> ['1', '3', '4', '5']
+
+    The order is kept, so "5:3" -> ['5', '4', '3'] (like in ESORT).
+    """
+    result = []
+    for part in uids.split(','):
+        if ':' in part:
+            start, end = (int(i) for i in part.split(':'))
+            step = 1 if end >= start else -1
+            result.extend(str(i) for i in range(start, end + step, step))
+        elif part:
+            result.append(part)
+    return result
+
+
+def parse_esearch(line):
+    """Uids and count from ESEARCH response
+
+    (TAG "A1") UID PARTIAL (1:3 5,2:1) COUNT 10 -> (['5', '2', '1'], 10)
+    """
+    if isinstance(line, bytes):
+        line = line.decode()
+    count = re.search(r'\bCOUNT (\d+)', line)
+    count = int(count.group(1)) if count else 0
+    found = re.search(r'\bPARTIAL \(\S+ ([^)\s]+)\)', line)
+    uids = found.group(1) if found else 'NIL'
+    return ([] if uids == 'NIL' else unpack_uids(uids)), count
+
+
 class Uids:
     __slots__ = ['val', 'batches', 'threads']
 
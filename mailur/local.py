@@ -2,17 +2,32 @@ import email
 import functools as ft
 import hashlib
 import imaplib
+import multiprocessing
 import re
 import textwrap
+from collections import ChainMap
+from concurrent import futures
+from contextlib import ExitStack, contextmanager
+from types import MappingProxyType
 
-from gevent import joinall, socket, spawn
+from gevent import get_hub, joinall, socket, spawn
+from gevent.local import local as gevent_local
 
-from . import cache, conf, fn_time, html, imap, json, lock, log, message
+from . import (
+    cache, conf, fn_time, html, imap, json, lock, log, message, packed
+)
 
 SRC = 'mlr'
 ALL = 'mlr/All'
 SYS = 'mlr/Sys'
 DEL = 'mlr/Del'
+JOURNAL = 'journal:'
+MDKEY = 'mlr'
+
+txn = gevent_local()
+uidpairs_codec = packed.Codec(packed.UidMap)
+threads_codec = packed.Codec(packed.UidMap, packed.UidLists)
+recency_codec = packed.Codec(packed.UidTimes)
 
 
 class Local(imaplib.IMAP4, imap.Conn):
@@ -55,96 +70,543 @@ def using(box=ALL, **kw):
 
 @using(SYS)
 def metadata_uids(con=None):
+    """Map of document names to their uids: a snapshot then journal uids"""
     def get_map():
-        uids = {}
+        docs, journals = {}, {}
         all_uids = set()
         res = con.fetch('1:*', '(UID BODY[HEADER.FIELDS (Subject)])')
         for i in range(0, len(res), 2):
             uid = res[i][0].decode().split()[2]
             name = re.sub(r'^Subject: ?', '', res[i][1].decode()).strip()
-            if name not in uids or int(uids[name]) < int(uid):
-                uids[name] = uid
             all_uids.add(uid)
-        clean = all_uids.difference(uids.values())
-        if clean and len(clean) > 100:
-            with client(SYS, readonly=False) as c:
-                c.store(clean, '+FLAGS.SILENT', '\\Deleted')
-                c.expunge()
-        return uids
+            if name.startswith(JOURNAL):
+                journals.setdefault(name[len(JOURNAL):], []).append(uid)
+            elif name not in docs or int(docs[name]) < int(uid):
+                docs[name] = uid
+
+        uids = {}
+        for name, uid in docs.items():
+            journal = (i for i in journals.get(name, []) if int(i) > int(uid))
+            uids[name] = [uid] + sorted(journal, key=int)
+
+        clean = all_uids.difference(sum(uids.values(), []))
+        return uids, metadata_clean(sorted(clean, key=int))
+
+    def get_index():
+        entries = con.getmetadata(SYS, MDKEY, depth='infinity')
+        uidnext = entries.pop(metadata_key('uidnext'), None)
+        if uidnext != str(con.uidnext):
+            return None, None
+
+        clean = entries.pop(metadata_key('clean'), None)
+        prefix = metadata_key('doc/')
+        return {
+            k[len(prefix):]: v.split() for k, v in entries.items()
+            if k.startswith(prefix) and v
+        }, (clean or '').split()
 
     get_map = fn_time(get_map, 'metadata_uids.get_map')
+    get_index = fn_time(get_index, 'metadata_uids.get_index')
 
     cache_key = 'metadata'
     value = cache.get(cache_key)
-    if not value or con.uidnext != value['uidnext']:
-        data = {'uidnext': con.uidnext, 'map': get_map()}
-        cache.set(cache_key, data)
-    return cache.get(cache_key)['map']
+    if not value or int(con.uidnext) != value['uidnext']:
+        uidnext = int(con.uidnext)
+        uids, clean = get_index()
+        if uids is None:
+            uids, clean = get_map()
+            entries = {
+                metadata_key('doc/%s' % k): ' '.join(v)
+                for k, v in uids.items()
+            }
+            entries[metadata_key('uidnext')] = uidnext
+            entries[metadata_key('clean')] = ' '.join(clean) or None
+            con.setmetadata(SYS, entries)
+        value = {'uidnext': uidnext, 'map': uids, 'clean': clean}
+        cache.set(cache_key, value)
+    return value['map']
+
+
+def metadata_key(name):
+    return '/private/%s/%s' % (MDKEY, name)
+
+
+def metadata_docs(con):
+    """Uids of documents including pending ones in "metadata_txn" block"""
+    docs = metadata_uids(con=con)
+    pending = getattr(txn, 'docs', None)
+    if pending:
+        docs = dict(docs, **{k: v[0] for k, v in pending.items()})
+    return docs
+
+
+def metadata_saved(con, docs, uids):
+    """Update uids of documents after own APPEND
+
+    If nobody else appended to SYS meanwhile, the first new uid is equal
+    to cached "uidnext", so the map is still valid and no rescan is needed.
+    The same goes for METADATA index, otherwise it is rebuilt by the next
+    reader.
+
+    Messages superseded by a new snapshot are collected in the index
+    and expunged by batches (see "metadata_clean").
+    """
+    value = cache.get('metadata')
+    first, last = int(uids[0]), int(uids[-1])
+    if not value or value['uidnext'] != first or last - first >= len(uids):
+        return
+    clean = value['clean'] + [
+        i for name, doc_uids in docs.items()
+        for i in value['map'].get(name, []) if i not in doc_uids
+    ]
+    value['clean'] = metadata_clean(clean)
+    value['map'].update(docs)
+    value['uidnext'] = last + 1
+    entries = {
+        metadata_key('doc/%s' % k): ' '.join(v) for k, v in docs.items()
+    }
+    entries[metadata_key('uidnext')] = value['uidnext']
+    entries[metadata_key('clean')] = ' '.join(value['clean']) or None
+    con.setmetadata(SYS, entries)
+
+
+def metadata_clean(uids, limit=100):
+    """Expunge useless messages of SYS when there are enough of them
+
+    Returns uids which are left for the next time.
+    """
+    if len(uids) <= limit:
+        return uids
+
+    with client(SYS, readonly=False) as con:
+        con.store(uids, '+FLAGS.SILENT', '\\Deleted')
+        con.expunge()
+    log.info('## expunged %s useless messages of metadata', len(uids))
+    return []
+
+
+@contextmanager
+def metadata_txn():
+    """Buffer metadata writes and save them with one MULTIAPPEND
+
+    Inside the block changed documents are read from the buffer.
+    """
+    if getattr(txn, 'docs', None) is not None:
+        # nested one
+        yield
+        return
+
+    txn.docs, txn.msgs, txn.locked = {}, [], set()
+    with ExitStack() as txn.locks:
+        try:
+            yield
+            docs, msgs = txn.docs, txn.msgs
+        except Exception:
+            # cached values could be changed in place already
+            cache.clear()
+            raise
+        finally:
+            txn.docs = txn.msgs = txn.locked = None
+
+        if msgs:
+            metadata_commit(docs, msgs)
+
+
+@contextmanager
+def metadata_lock(target, **opts):
+    """Lock which is held till the commit of "metadata_txn" block
+
+    Otherwise other process could read documents before buffered writes
+    are saved and overwrite them after.
+    """
+    locked = getattr(txn, 'locked', None)
+    if locked is None:
+        with lock.user_scope(target, **opts):
+            yield
+        return
+
+    if target not in locked:
+        txn.locks.enter_context(lock.user_scope(target, **opts))
+        locked.add(target)
+    yield
+
+
+@fn_time
+@using(SYS)
+def metadata_commit(docs, msgs, con=None):
+    uids = con.multiappend(SYS, [(None, name, raw) for name, raw in msgs])
+    uids = imap.unpack_uids(uids)
+    new = {}
+    for (name, raw), uid in zip(msgs, uids):
+        new.setdefault(name, []).append(uid)
+
+    saved = {}
+    for name, (doc_uids, *_, done) in docs.items():
+        doc_uids = [i for i in doc_uids if i is not None] + new[name]
+        saved[name] = doc_uids
+        done(doc_uids)
+    metadata_saved(con, saved, uids)
+
+
+def metadata_apply(value, delta):
+    for key, val in delta.items():
+        if val is None:
+            value.pop(key, None)
+        else:
+            value[key] = val
+    return value
+
+
+def metadata_view(value):
+    """Read-only view of cached value (nested values are shared)"""
+    if isinstance(value, dict):
+        return MappingProxyType(value)
+    elif isinstance(value, packed.TYPES):
+        return packed.View(value)
+    elif isinstance(value, (list, tuple)):
+        return type(value)(metadata_view(i) for i in value)
+    return value
+
+
+def metadata_copy(value):
+    """Copy of cached value to change it, nested values are shared"""
+    if isinstance(value, (dict,) + packed.TYPES):
+        return value.copy()
+    elif isinstance(value, (list, tuple)):
+        return type(value)(metadata_copy(i) for i in value)
+    return value
+
+
+def metadata_doc(name, default, journal=None, codec=None):
+    """One document saved as a message in SYS folder.
 
+    With "journal" (works for dicts only) ".update(delta)" appends
+    a small delta to the journal instead of the whole document,
+    a delta value "None" removes the key. When the journal is longer
+    than "journal" entries it is folded into a new snapshot.
 
-def metadata(name, default):
+    With "codec" (see "packed.Codec") the snapshot is saved as binary
+    data instead of JSON, journal is in JSON anyway.
+    """
     cache_key = 'metadata:%s' % name
 
-    @using(SYS, name='_con')
-    @lock.user_scope(name)
-    def inner(*a, **kw):
-        con = kw.pop('_con')
-        val = inner.fn(*a, **kw)
-        data = json.dumps(val, sort_keys=True)
-        msg = message.binary(data)
-        msg.add_header('Subject', name)
-        uidlatest = con.append(SYS, name, None, msg.as_bytes())
-        cache.set(cache_key, (uidlatest, val))
-        return val
+    def dumps(value):
+        if codec:
+            return codec.dumps(value)
+        return json.dumps(value, sort_keys=True)
+
+    def loads(data):
+        if codec:
+            return codec.loads(data)
+        return json.loads(data.decode())
+
+    def save(uids, value, digest, size, shared=True):
+        # size of saved data is used as rough size of the value for cache
+        cached = (uids, value, digest, size)
+        cache.set(cache_key, cached, size=size)
+        if shared:
+            if codec:
+                cached = (uids, codec.dumps(value), digest, size)
+            cache.shared_set(cache_key, cached)
+
+    def current():
+        pending = getattr(txn, 'docs', None)
+        if pending and name in pending:
+            return pending[name][:4]
+        return cache.get(cache_key)
+
+    def append(con, subject, data, uids, value, digest, size, shared=True):
+        if isinstance(data, bytes):
+            msg = message.new()
+            msg.set_content(data, *codec.mimetype.split('/'))
+        else:
+            msg = message.binary(data)
+        msg.add_header('Subject', subject)
+        if getattr(txn, 'docs', None) is None:
+            uids = uids + [con.append(SYS, name, None, msg.as_bytes())]
+            metadata_saved(con, {name: uids}, uids[-1:])
+            save(uids, value, digest, size, shared)
+            return
+
+        if subject == name:
+            # new snapshot makes previous messages useless
+            txn.msgs = [i for i in txn.msgs if i[0] != name]
+        txn.msgs.append((name, msg.as_bytes()))
+        done = ft.partial(
+            save, value=value, digest=digest, size=size, shared=shared
+        )
+        txn.docs[name] = (uids + [None], value, digest, size, done)
+
+    @using(SYS)
+    def put(value, con=None):
+        if codec:
+            value = codec.convert(value)
+        data = dumps(value)
+        raw = data if isinstance(data, bytes) else data.encode()
+        digest = hashlib.md5(raw).hexdigest()
+        uids = metadata_docs(con).get(name)
+        cached = current()
+        if cached and cached[0] == uids and cached[2] == digest:
+            # nothing changed since the last save
+            return value
+
+        append(con, name, data, [], value, digest, len(data))
+        return value
+
+    @using(SYS)
+    def update(delta, con=None):
+        if not delta:
+            return
+
+        uids = metadata_docs(con).get(name)
+        value = metadata_apply(metadata_copy(get(con=con)), delta)
+        if not uids or len(uids) > journal:
+            put(value, con=con)
+            return
+
+        data = json.dumps(delta, sort_keys=True)
+        size = (current()[3] or 0) + len(data)
+        append(con, JOURNAL + name, data, uids, value, None, size, False)
 
     @using(SYS)
     def get(con=None):
-        uidlatest = metadata_uids(con=con).get(name)
-        if not uidlatest:
+        pending = getattr(txn, 'docs', None)
+        if pending and name in pending:
+            return pending[name][1]
+
+        uids = metadata_uids(con=con).get(name)
+        if not uids:
             if isinstance(default, Exception):
                 raise default
             return default()
 
-        if cache.exists(cache_key):
-            uid, value = cache.get(cache_key)
-            if uid == uidlatest:
+        value = digest = None
+        # the shared cache is read only if the in-process one isn't fresh
+        getters = (cache.get, cache.shared_get)
+        for cached in (get_cached(cache_key) for get_cached in getters):
+            if not cached:
+                continue
+            cached_uids, value, digest, size = cached
+            if isinstance(value, bytes):
+                value = codec.loads(value)
+                cached = (cached_uids, value, digest, size)
+            if cached_uids == uids:
+                if not cache.exists(cache_key):
+                    save(*cached, shared=False)
                 return value
+            elif cached_uids == uids[:len(cached_uids)]:
+                # only fresh journal entries are needed
+                fresh = uids[len(cached_uids):]
+                value = metadata_copy(value)
+                break
+            value = None
+
+        def fetch(uids):
+            res = con.fetch(uids, 'BINARY.PEEK[1]')
+            return [res[i][1] for i in range(0, len(res), 2)]
+
+        fetch = fn_time(fetch, 'metadata:%s.fetch' % name)
+        if value is None:
+            fresh = uids[1:]
+            res = fetch(uids[0])
+            size = len(res[0]) if res else 0
+            if res:
+                value = loads(res[0])
+                digest = hashlib.md5(res[0]).hexdigest()
+            else:
+                value = default()
+        if fresh:
+            digest = None
+            for data in fetch(fresh):
+                size += len(data)
+                metadata_apply(value, json.loads(data.decode()))
+        save(uids, value, digest, size)
+        return value
 
-        def fetch():
-            res = con.fetch(uidlatest, 'BODY.PEEK[1]')
-            if res and res[0]:
-                data = json.loads(res[0][1].decode())
-                return data
-            return default()
+    put.get = get
+    put.update = update
+    return put
+
+
+def metadata(name, default, journal=None, shard=None, codec=None):
+    """Persistent document, see "metadata_doc" for details.
+
+    With "shard" a dict (or a list of dicts) keyed by uids is split into
+    documents per "shard" uids, so writes and ".key(...)" lookups touch
+    only affected documents.
+    """
+    cache_key = 'metadata:%s:all' % name
+    docs = {}
+
+    def doc(num=None):
+        sub = name if num is None else '%s:%s' % (name, num)
+        if sub not in docs:
+            docs[sub] = metadata_doc(sub, default, journal, codec)
+        return docs[sub]
+
+    def shards(con):
+        uids = metadata_docs(con)
+        pattern = re.compile(r'^%s:(\d+)$' % re.escape(name))
+        found = (pattern.match(i) for i in uids)
+        nums = sorted(int(m.group(1)) for m in found if m)
+        return [(num, uids['%s:%s' % (name, num)]) for num in nums]
+
+    def split(value):
+        items = value if isinstance(value, (list, tuple)) else [value]
+        parts = {}
+        for idx, item in enumerate(items):
+            for key, val in item.items():
+                part = parts.setdefault(int(key) // shard, [{} for i in items])
+                part[idx][key] = val
+        if items is value:
+            return parts
+        return {num: part[0] for num, part in parts.items()}
+
+    def size(found):
+        # merged value is as big as all shards, their sizes are cached
+        keys = ('metadata:%s:%s' % (name, num) for num, _ in found)
+        return sum(i[3] or 0 for i in map(cache.get, keys) if i)
+
+    def merge(parts):
+        value = default()
+        items = value if isinstance(value, (list, tuple)) else [value]
+        for part in parts:
+            part = part if isinstance(part, (list, tuple)) else [part]
+            for item, few in zip(items, part):
+                item.update(few)
+        return value
+
+    @using(SYS)
+    def get(con=None):
+        found = shard and shards(con)
+        if not found:
+            return doc().get(con=con)
 
-        value = fn_time(fetch, '%s.fetch' % inner.__name__)()
-        cache.set(cache_key, (uidlatest, value))
+        cached = cache.get(cache_key)
+        if cached and cached[0] == found:
+            return cached[1]
+
+        value = merge(doc(num).get(con=con) for num, _ in found)
+        cache.set(cache_key, (found, value), size=size(found))
         return value
 
-    def key(name, default=None):
-        return get().get(name, default)
+    @using(SYS)
+    def put(value, con=None):
+        if not shard:
+            return doc()(value, con=con)
+
+        if codec:
+            value = codec.convert(value)
+        parts = split(value)
+        nums = set(num for num, _ in shards(con)).union(parts)
+        for num in sorted(nums):
+            doc(num)(parts.get(num, default()), con=con)
+        found = shards(con)
+        cache.set(cache_key, (found, value), size=size(found))
+        return value
+
+    @using(SYS)
+    def update(delta, con=None):
+        if not shard:
+            return doc().update(delta, con=con)
+
+        if not shards(con) and name in metadata_uids(con=con):
+            # split the document saved before sharding
+            put(doc().get(con=con), con=con)
+
+        for num, part in split(delta).items():
+            doc(num).update(part, con=con)
+        # merged value is rebuilt from updated shards on the next "get"
+        cache.rm(cache_key)
+
+    @using(SYS, name='_con')
+    @metadata_lock(name)
+    def inner(*a, **kw):
+        con = kw.pop('_con')
+        return put(inner.fn(*a, **kw), con=con)
+
+    @using(SYS, name='_con')
+    @metadata_lock(name)
+    def update_locked(delta, _con=None):
+        update(delta, con=_con)
+
+    @using(SYS)
+    def many(keys, con=None):
+        """Only requested keys, so only needed shards are loaded"""
+        if not (shard and shards(con)):
+            value = get(con=con)
+            return {k: value[k] for k in keys if k in value}
+
+        nums = {}
+        for k in keys:
+            nums.setdefault(int(k) // shard, []).append(k)
+        found = {}
+        for num, few in sorted(nums.items()):
+            value = doc(num).get(con=con)
+            found.update((k, value[k]) for k in few if k in value)
+        return found
+
+    def key(k, default=None):
+        return many([k]).get(k, default)
+
+    def view():
+        return metadata_view(get())
+
+    def edit():
+        """Copy of the value to change it and save afterwards"""
+        return metadata_copy(get())
 
     def wrapper(fn):
         inner_fn = ft.wraps(fn)(inner)
         inner_fn.fn = fn
-        inner_fn.get = get
+        inner_fn.get = view
+        inner_fn.edit = edit
         inner_fn.key = key
+        inner_fn.many = many
+        if journal:
+            inner_fn.update = update_locked
         return inner_fn
     return wrapper
 
 
-def metakey(metavalue, name, default=None):
-    @lock.user_scope('%s:%s' % (metavalue.__name__, name))
+@metadata('settings', lambda: {})
+def data_settings(update=None):
+    """Settings saved before each one got own document, read-only now."""
+    settings = data_settings.edit()
+    settings.update(update)
+    return settings
+
+
+def setting(name, default=None, journal=None):
+    """Persistent setting saved in own document
+
+    With "journal" the function returns a delta, which is saved to
+    the journal (see "metadata_doc").
+    """
+    doc = metadata_doc('settings/%s' % name, lambda: None, journal)
+
+    @using(SYS, name='_con')
+    @metadata_lock('settings:%s' % name)
     def inner(*a, **kw):
+        con = kw.pop('_con')
         val = inner.fn(*a, **kw)
-        metavalue({name: val})
+        if journal and doc.get(con=con) is not None:
+            doc.update(val, con=con)
+        elif journal:
+            doc(metadata_apply(dict(get()), val), con=con)
+        else:
+            doc(val, con=con)
         return val
 
     def unset():
-        metavalue({name: None})
-
-    def get(default=default):
-        value = metavalue.key(name)
+        doc(None)
+        if data_settings.key(name) is not None:
+            data_settings({name: None})
+
+    def raw(default=default):
+        value = doc.get()
+        if value is None:
+            value = data_settings.key(name)
         if value is not None:
             return value
         elif default and isinstance(default, Exception):
@@ -154,30 +616,28 @@ def metakey(metavalue, name, default=None):
         else:
             return default
 
+    def get(default=default):
+        """Read-only view of the value, see "edit" to change it"""
+        return metadata_view(raw(default))
+
     def key(name, default=None):
         return get().get(name, default)
 
+    def edit(default=default):
+        """Copy of the value to change it and save afterwards"""
+        return metadata_copy(raw(default))
+
     def wrapper(fn):
         inner_fn = ft.wraps(fn)(inner)
         inner_fn.fn = fn
         inner_fn.get = get
+        inner_fn.edit = edit
         inner_fn.key = key
         inner_fn.unset = unset
         return inner_fn
     return wrapper
 
 
-@metadata('settings', lambda: {})
-def data_settings(update=None):
-    """All persistent stuff saved under the one metadata row."""
-    settings = data_settings.get()
-    settings.update(update)
-    return settings
-
-
-setting = ft.partial(metakey, data_settings)
-
-
 @setting('uidnext')
 def data_uidnext(value):
     return value
@@ -190,36 +650,91 @@ def data_modseq(value):
 
 @setting('links', lambda: [])
 def data_links(links):
+    """Groups of linked message-ids saved before, read-only now."""
     return links
 
 
-@setting('drafts', lambda: {})
+@setting('linked', lambda: {}, journal=100)
+def data_linked(update):
+    """Linked message-ids as disjoint-set, see "links_find"."""
+    return update
+
+
+def links_get():
+    """Linked message-ids, groups saved before are converted once"""
+    links = data_linked.get()
+    if links or not data_links.get():
+        return links
+
+    delta = {}
+    for link in data_links.get():
+        links_union(ChainMap(delta, links), link)
+    data_linked(delta)
+    data_links.unset()
+    return data_linked.get()
+
+
+def links_find(links, mid):
+    """Root of linked message-ids or None if message-id isn't linked
+
+    A root keeps all message-ids of own set, other message-ids point
+    to the root, so a lookup is one step.
+    """
+    value = links.get(mid)
+    if isinstance(value, list):
+        return mid
+    return value
+
+
+def links_members(links, root):
+    return links.get(root) or [root]
+
+
+def links_union(links, mids):
+    """Join sets of message-ids, the smaller sets are moved"""
+    roots = set(links_find(links, i) or i for i in mids)
+    sets = {i: links_members(links, i) for i in roots}
+    root = max(roots, key=lambda i: (len(sets[i]), i))
+    members = list(sets[root])
+    for i in roots.difference([root]):
+        members.extend(sets[i])
+        for mid in sets[i]:
+            links[mid] = root
+    links[root] = members
+
+
+def links_unlink(links, mids):
+    roots = set(links_find(links, i) for i in mids)
+    for root in roots.difference([None]):
+        for mid in links_members(links, root):
+            links[mid] = None
+
+
+@setting('drafts', lambda: {}, journal=100)
 def data_drafts(update):
-    data = data_drafts.get()
-    for key, val in update.items():
-        if val is None:
-            data.pop(key, None)
-        else:
-            data[key] = val
-    return data
+    return update
 
 
-@setting('filters', lambda: {})
+@setting('filters', lambda: {}, journal=100)
 def data_filters(update):
-    data = data_filters.get()
-    for key, val in update.items():
-        if val is None:
-            data.pop(key, None)
-        else:
-            data[key] = val
-    return data
+    return update
 
 
-@setting('tags', lambda: {})
+@setting('tags', lambda: {}, journal=100)
 def data_tags(update=None):
-    tags = data_tags.get()
-    tags.update(update)
-    return tags
+    return update
+
+
+@setting('charsets', lambda: {}, journal=100)
+def data_charsets(update):
+    """Detected charsets by sender (hints for detection)"""
+    return update
+
+
+@setting('charsets_detected', lambda: {})
+def data_charsets_detected(counts):
+    """How many times every detector has found a charset"""
+    return counts
 
 
 def get_tag(name, *, tags=None):
@@ -249,7 +764,7 @@ def get_tag(name, *, tags=None):
         tag = '#' + hashlib.md5(name.lower().encode()).hexdigest()[:8]
 
     if not tags:
-        tags = data_tags.get()
+        tags = data_tags.edit()
     info = tags.get(tag)
     if info is None:
         info = {'name': name}
@@ -259,47 +774,123 @@ def get_tag(name, *, tags=None):
             tags[tag] = info
             data_tags({tag: info.copy()})
             log.info('## new tag %s: %r', tag, name)
-    info.update(id=tag, query=query(tag))
-    return info
+    return dict(info, id=tag, query=query(tag))
+
+
+@setting('tagcounts', lambda: {})
+def data_tagcounts(counts):
+    """Threads and unread messages in them by tags, see "tags_counts"."""
+    return counts
+
+
+@metadata('tagthrs', lambda: {}, journal=100, shard=10000)
+def data_tagthrs(thrs):
+    """Unread messages and tags of threads (only not empty ones)"""
+    return thrs
+
+
+def tags_fetch(uids, con, modseq=None):
+    fields = '(UID FLAGS)'
+    if modseq:
+        fields += ' (CHANGEDSINCE %s)' % modseq
+    flags = {}
+    for line in con.fetch(uids, fields):
+        val = re.search(r'UID (\d+) FLAGS \(([^)]*)\)', line.decode())
+        if val:
+            uid, val = val.groups()
+            flags[uid] = val.split()
+    return flags
+
+
+def tags_thread(uids, flags):
+    unread, tags = 0, set()
+    for uid in uids:
+        if uid not in flags:
+            continue
+        elif not {'\\Seen', '#trash', '#spam'}.intersection(flags[uid]):
+            unread += 1
+        tags.update(i for i in flags[uid] if not i.startswith('\\'))
+    tags.difference_update(('#trash', '#spam', '#sent', '#err'))
+    return [unread, sorted(tags)] if unread or tags else None
+
+
+@using()
+@metadata_txn()
+@metadata_lock('tagcounts', wait=10)
+def update_tagcounts(thrids=None, modseq=None, con=None):
+    """Recount given threads, counters are changed by difference
+
+    Without "thrids" all threads are counted from scratch.
+    """
+    saved = data_tagcounts.get()
+    if thrids is not None and not saved:
+        return
+
+    _, thrs = data_threads.get()
+    full = thrids is None
+    if full:
+        thrids = list(thrs)
+        flags = tags_fetch('1:*', con) if thrs else {}
+        counts, old = {'unread': 0, 'tags': {}}, {}
+    else:
+        uids = sum((thrs[i] for i in thrids if i in thrs), [])
+        flags = tags_fetch(uids, con) if uids else {}
+        counts = {'unread': saved['unread'], 'tags': dict(saved['tags'])}
+        old = data_tagthrs.many(thrids)
+
+    new = {i: thrs.get(i) and tags_thread(thrs[i], flags) for i in thrids}
+    new = {i: v or None for i, v in new.items()}
+    for stat, sign in ((old, -1), (new, 1)):
+        for unread, tags in filter(None, stat.values()):
+            counts['unread'] += sign * unread
+            for tag in tags:
+                threads, count = counts['tags'].get(tag, (0, 0))
+                counts['tags'][tag] = [threads + sign, count + sign * unread]
+    counts['tags'] = {t: v for t, v in counts['tags'].items() if v[0] > 0}
+    counts['modseq'] = modseq or saved.get('modseq', 0)
+
+    if full:
+        data_tagthrs({i: v for i, v in new.items() if v})
+    else:
+        data_tagthrs.update(new)
+    data_tagcounts(counts)
+    log.info('## recounted tags of %s threads', len(thrids))
+    return counts
+
+
+def tags_counts(con):
+    """Counters of tags kept by flag changes (CONDSTORE)
+
+    Only threads with changed messages since the last call are recounted.
+    """
+    counts = data_tagcounts.get()
+    modseq = con.highestmodseq
+    if not counts:
+        return update_tagcounts(modseq=modseq, con=con)
+    elif counts['modseq'] >= modseq:
+        return counts
+
+    thrids = data_threads.get()[0]
+    flags = tags_fetch('1:*', con, counts['modseq'])
+    changed = set(thrids[i] for i in flags if i in thrids)
+    return update_tagcounts(changed, modseq, con=con)
 
 
 @fn_time
 @using()
 def tags_info(con=None):
-    def query(tag):
-        if tag.startswith('\\'):
-            return tag[1:]
-        return 'keyword %s' % tag
-
-    thrids, thrs = data_threads.get()
-    unread_uids = set(con.search('(UNSEEN UNKEYWORD #trash UNKEYWORD #spam)'))
-    special = {
-        '\\Seen', '\\Deleted', '\\Answered', '\\Flagged', '\\Draft',
-        '#trash', '#spam', '#sent', '#err'
-    }
+    counts = tags_counts(con)
     tags = {
-        '#unread': {'unread': len(unread_uids)},
+        '#unread': {'unread': counts['unread']},
         '#inbox': {'pinned': 1, 'unread': 0}
     }
-    tags_info = data_tags.get()
-    for tag in con.flags:
-        if tag in special:
-            continue
-        uids = con.search(query(tag))
-        if not uids:
-            continue
+    tags_info = data_tags.edit()
+    for tag, (threads, unread) in counts['tags'].items():
         tags.setdefault(tag, {'unread': 0})
         name = tags_info.get(tag, {}).get('name', tag)
         if not re.search('^[#.-]', name):
             continue
-        unread = set()
-        for uid in uids:
-            thrid = thrids.get(uid)
-            if not thrid:
-                continue
-            thr = thrs[thrid]
-            unread.update(unread_uids.intersection(thr))
-        tags[tag].update(unread=len(unread), pinned=1)
+        tags[tag].update(unread=unread, pinned=1)
     tags = {t: dict(get_tag(t, tags=tags_info), **v) for t, v in tags.items()}
     tags.update({
         t: dict(get_tag(t, tags=tags_info), **tags.get(t, {'unread': 0}))
@@ -347,13 +938,15 @@ def sieve_scripts(name=None):
     require ["imap4flags"];
     ''').strip()
 
-    data = data_filters.get()
+    data = data_filters.edit()
     data['manual'] = data.get('manual', manual)
     data['auto'] = data.get('auto', auto)
     return data[name] if name else data
 
 
-@metadata('uidpairs', lambda: {})
+@metadata(
+    'uidpairs', uidpairs_codec, journal=100, shard=10000, codec=uidpairs_codec
+)
 def data_uidpairs(pairs):
     return pairs
 
@@ -363,58 +956,61 @@ def data_addresses(addrs_from, addrs_to):
     return [addrs_from, addrs_to]
 
 
-@metadata('msgs', lambda: {})
+@metadata('msgs', lambda: {}, journal=100, shard=10000)
 def data_msgs(msgs):
     return msgs
 
 
-@metadata('msgids', lambda: {})
+@metadata('msgids', lambda: {}, journal=100)
 def data_msgids(mids):
     return mids
 
 
+@metadata_lock('update_threads')
 def clean_threads(uids):
-    thrids, thrs = data_threads.get()
+    thrids, thrs = data_threads.edit()
+    uids = set(uids)
     cleaned_uids = []
     cleaned = set()
-    for uid in uids:
-        thrid = thrids.pop(uid, None)
+    found = set(thrids[i] for i in uids if i in thrids)
+    for thrid in found:
         thr = thrs.get(thrid)
-        if uid == thrid:
-            del thrs[uid]
+        if not thr:
+            continue
+        elif thrid in uids:
+            del thrs[thrid]
             cleaned_uids.extend(thr)
-            cleaned.add(uid)
-        elif thr:
-            thr.remove(uid)
-    for uid in cleaned_uids:
+            cleaned.add(thrid)
+        else:
+            thrs[thrid] = [i for i in thr if i not in uids]
+    for uid in uids.union(cleaned_uids):
         thrids.pop(uid, None)
 
     data_threads(thrids, thrs)
+    update_recency(thrs, {i: None for i in cleaned})
+    update_tagcounts(found)
     log.info('## cleaned %s threads', len(cleaned))
     return cleaned_uids
 
 
 def clean_msgs(uids):
     msgs = data_msgs.get()
-    uidpairs = data_uidpairs.get()
     msgids = data_msgids.get()
 
+    cleaned_msgs, cleaned_pairs, mids = {}, {}, {}
     for uid in uids:
-        msg = msgs.pop(uid, None)
+        msg = msgs.get(uid)
         if not msg:
             continue
-        uidpairs.pop(msg['origin_uid'], None)
+        cleaned_msgs[uid] = None
+        cleaned_pairs[msg['origin_uid']] = None
         mid = msg['msgid']
-        ids = msgids[mid]
-        if len(ids) == 1:
-            del msgids[mid]
-        else:
-            ids.remove(uid)
-            msgids[mid] = ids
+        ids = [i for i in mids.get(mid, msgids[mid]) if i != uid]
+        mids[mid] = ids or None
 
-    data_msgs(msgs)
-    data_uidpairs(uidpairs)
-    data_msgids(msgids)
+    data_msgs.update(cleaned_msgs)
+    data_uidpairs.update(cleaned_pairs)
+    data_msgids.update(mids)
     log.info('## cleaned %s messages' % len(uids))
 
 
@@ -497,10 +1093,14 @@ def diagnose(con_all=None, con_src=None):
             f'  thrids_pids.difference(pids)={thrids_pids.difference(pids)}'
         )
 
+    detected = dict(data_charsets_detected.get())
+    print(f'Charsets found by detectors: {detected}')
+
 
 @fn_time
 @using()
 @lock.user_scope('update_metadata', wait=10)
+@metadata_txn()
 def update_metadata(uids=None, clean=False, con=None):
     if clean:
         clean_msgs(uids)
@@ -508,26 +1108,28 @@ def update_metadata(uids=None, clean=False, con=None):
         if not uids:
             return
 
-    if uids == '1:*':
-        msgs = {}
+    full = uids == '1:*'
+    if full:
         addrs_from, addrs_to = {}, {}
-        uidpairs = {}
         msgids = {}
-        thrids, thrs = {}, {}
     else:
-        msgs = data_msgs.get()
-        addrs_from, addrs_to = data_addresses.get()
-        uidpairs = data_uidpairs.get()
+        addrs_from, addrs_to = data_addresses.edit()
         msgids = data_msgids.get()
-        thrids, thrs = None, None
 
         if uids is None:
+            uidpairs = data_uidpairs.get()
             if uidpairs:
                 uidmax = max(uidpairs.values(), key=lambda v: int(v))
             else:
                 uidmax = 1
             uids = '%s:*' % uidmax
 
+    # for incremental updates only new items are saved into journals
+    msgs, uidpairs, mids, refs = {}, {}, {}, {}
+    hints = data_charsets.get()
+    detected = {} if full else dict(data_charsets_detected.get())
+    new_hints = {}
+
     def fill_addrs(store, meta, fields):
         addrs = (meta[i] for i in fields if meta.get(i))
         addrs = sum(([a] if isinstance(a, dict) else a for a in addrs), [])
@@ -537,13 +1139,15 @@ def update_metadata(uids=None, clean=False, con=None):
                 addr['time'] = meta['date']
                 store[a] = addr
             elif store[a]['time'] < meta['date']:
-                store[a]['time'] = meta['date']
+                store[a] = dict(store[a], time=meta['date'])
 
-    res = con.fetch(imap.Uids(uids), '(FLAGS BINARY.PEEK[1])')
-    for i in range(0, len(res), 2):
+    fields = '(FLAGS BINARY.PEEK[1] BODY.PEEK[HEADER.FIELDS (References)])'
+    res = con.fetch(imap.Uids(uids), fields)
+    for i in range(0, len(res), 3):
         pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
         uid, flags = re.search(pattern, res[i][0].decode()).groups()
         info = json.loads(res[i][1])
+        refs[uid] = refs_parse(res[i + 1][1])
         keys = ('arrived', 'draft_id', 'msgid', 'origin_uid', 'from', 'parent')
         small_info = {k: v for k, v in info.items() if k in keys}
         msgs[uid] = small_info
@@ -551,54 +1155,70 @@ def update_metadata(uids=None, clean=False, con=None):
 
         # message-ids
         mid = info['msgid']
-        ids = msgids.get(mid, [])
+        ids = mids.get(mid, msgids.get(mid, []))
         if uid not in ids:
-            ids.append(uid)
-            if len(ids) > 1:
-                ids = sorted(ids, key=lambda i: int(i))
-            msgids[mid] = ids
+            mids[mid] = sorted(ids + [uid], key=lambda i: int(i))
+
+        # charsets
+        sender = (info.get('from') or {}).get('addr')
+        for detector, charset in info.get('detected', []):
+            detected[detector] = detected.get(detector, 0) + 1
+            if detector != 'chardet' or not sender:
+                continue
+            if hints.get(sender.lower()) != charset:
+                new_hints[sender.lower()] = charset
 
         # addresses
         if {'#sent', '\\Draft'}.intersection(flags.split()):
             fill_addrs(addrs_from, info, ('from',))
             fill_addrs(addrs_to, info, ('from', 'to', 'cc'))
 
-    data_msgs(msgs)
-    data_uidpairs(uidpairs)
-    data_msgids(msgids)
+    if full:
+        data_msgs(msgs)
+        data_uidpairs(uidpairs)
+        data_msgids(mids)
+    else:
+        data_msgs.update(msgs)
+        data_uidpairs.update(uidpairs)
+        data_msgids.update(mids)
     data_addresses(addrs_from, addrs_to)
-    update_threads(uids, thrids, thrs)
-    return msgs
+    if new_hints:
+        data_charsets(new_hints)
+    if detected != data_charsets_detected.get():
+        data_charsets_detected(detected)
+    update_threads('1:*' if full else list(msgs), refs)
 
 
 def pair_origin_uids(uids, uidpairs=None):
     if uidpairs is None:
-        uidpairs = data_uidpairs.get()
+        uidpairs = data_uidpairs.many(uids)
     return tuple(uidpairs[i] for i in uids if i in uidpairs)
 
 
 def pair_parsed_uids(uids, msgs=None):
     if msgs is None:
-        msgs = data_msgs.get()
+        msgs = data_msgs.many(uids)
     return tuple(msgs[i]['origin_uid'] for i in uids if i in msgs)
 
 
 @fn_time
 @using()
 @lock.user_scope('link_threads')
+@metadata_txn()
+@metadata_lock('update_threads')
 def link_threads(uids, unlink=False, con=None):
     thrids, thrs = data_threads.get()
-    all_uids = set(sum((thrs[thrids[uid]] for uid in uids), []))
+    all_uids = set().union(*(thrs[thrids[uid]] for uid in uids))
 
-    msgs = data_msgs.get()
-    links = data_links.get()
-
-    link = set(msgs[uid]['msgid'] for uid in all_uids)
-    links = [i for i in links if not link.intersection(i)]
-    if not unlink:
-        links.append(sorted(link))
+    msgs = data_msgs.many(all_uids)
+    links = ChainMap({}, links_get())
+    mids = set(msgs[uid]['msgid'] for uid in all_uids)
+    if unlink:
+        links_unlink(links, mids)
+    else:
+        links_union(links, mids)
 
-    data_links(links)
+    data_linked(links.maps[0])
     clean_threads(all_uids)
     update_threads(all_uids)
     return sorted(all_uids)
@@ -609,27 +1229,105 @@ def unlink_threads(uids):
 
 
 @using(SRC, reuse=False)
-def parse_msgs(uids, con=None):
+def parse_msgs(uids, pool=None, inflight=None, con=None):
+    """Parse messages and append them to "ALL"
+
+    With "inflight" messages are fetched, parsed and appended by chunks,
+    each chunk has no more than "inflight" bytes of original messages.
+    """
+    if not inflight:
+        return parse_chunk(uids, pool, con)
+
+    chunks, size = [[]], 0
+    for line in con.fetch(uids.str, '(UID RFC822.SIZE)'):
+        pattern = r'UID (\d+) RFC822.SIZE (\d+)'
+        uid, msg_size = re.search(pattern, line.decode()).groups()
+        size += int(msg_size)
+        if chunks[-1] and size > inflight:
+            chunks.append([])
+            size = int(msg_size)
+        chunks[-1].append(uid)
+    log.debug('%s messages in %s chunks', len(uids.val), len(chunks))
+    puids = (parse_chunk(imap.Uids(i), pool, con) for i in chunks if i)
+    return ','.join(i for i in puids if i)
+
+
+def parse_chunk(uids, pool, con):
     res = con.fetch(uids.str, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
+    items = []
+    for i in range(0, len(res), 2):
+        line, body = res[i]
+        pattern = r'UID (\d+) INTERNALDATE ("[^"]+") FLAGS \(([^)]*)\)'
+        uid, time, flags = re.search(pattern, line.decode()).groups()
+        items.append((body, uid, time, flags.split()))
+    del res
+
+    # only the hint of the sender is needed (and pickled for workers)
+    learned = data_charsets.get()
+    hints = []
+    for body, *_ in items:
+        sender = message.sender(body)
+        hints.append({sender: learned[sender]} if sender in learned else None)
+
+    keys = []
+    if conf['CACHE_DIR']:
+        keys = [parsed_key(*i, hints=h) for i, h in zip(items, hints)]
+    cached = {}
+    for num, key in enumerate(keys):
+        value = cache.shared_get(key)
+        if value:
+            cached[num] = value
+    if cached:
+        log.debug('%s messages are parsed already', len(cached))
+
+    if pool:
+        # the hub isn't blocked, so other batches are fetched meanwhile
+        jobs = {
+            num: pool.submit(message.parsed_bytes, *i, hints=hints[num])
+            for num, i in enumerate(items) if num not in cached
+        }
+        get_hub().threadpool.apply(futures.wait, (list(jobs.values()),))
 
     def msgs():
-        for i in range(0, len(res), 2):
-            line, body = res[i]
-            pattern = r'UID (\d+) INTERNALDATE ("[^"]+") FLAGS \(([^)]*)\)'
-            uid, time, flags = re.search(pattern, line.decode()).groups()
-            flags = flags.split()
+        for num, (body, uid, time, flags) in enumerate(items):
+            # original message isn't needed after parsing
+            items[num] = None
+            if num in cached:
+                msg, marks = cached.pop(num)
+                yield time, ' '.join(flags + marks), msg
+                continue
             try:
-                msg_obj, marks = message.parsed(body, uid, time, flags)
+                if pool:
+                    msg, marks = jobs.pop(num).result()
+                else:
+                    msg, marks = message.parsed_bytes(
+                        body, uid, time, flags, hints[num]
+                    )
             except Exception:
                 log.exception('UID=%s can\'t parse msg: body=%r', uid, body)
                 raise
-            flags += marks
-            msg = msg_obj.as_bytes()
-            yield time, ' '.join(flags), msg
+            if keys:
+                cache.shared_set(keys[num], (msg, marks))
+            yield time, ' '.join(flags + marks), msg
 
     return con.multiappend(ALL, list(msgs()))
 
 
+def parsed_key(body, uid, time, flags, hints=None):
+    """Key of parsed message in the shared cache
+
+    It's SHA256 of everything "message.parsed" result depends on, so
+    changed message (or headers added on import) is parsed again,
+    the same goes for a new charsets hint of the sender.
+    Results of each version of the parser are in own directory.
+    """
+    key = [message.VERSION, uid, time, '\\Draft' in flags]
+    if hints:
+        key.append(hints)
+    key = hashlib.sha256(json.dumps(key).encode() + body).hexdigest()
+    return 'parsed/v%s/%s/%s' % (message.VERSION, key[:2], key)
+
+
 @fn_time
 @using(ALL, readonly=False)
 def clean_parsed_msgs(uids, con=None):
@@ -643,7 +1341,18 @@ def clean_parsed_msgs(uids, con=None):
 @fn_time
 @lock.user_scope('parse')
 @using(None)
-def parse(criteria=None, con=None, **opts):
+def parse(criteria=None, procs=None, inflight_mb=None, con=None, **opts):
+    """Parse messages from "SRC" to "ALL"
+
+    With "procs" messages are parsed in the pool of worker processes.
+    With "inflight_mb" original messages in memory are limited for all
+    batches together (a bigger message is still processed alone).
+    """
+    # results of previous versions of the parser aren't needed anymore
+    cache.shared_clean('parsed', keep=['v%s' % message.VERSION])
+
+    # "uidnext" is saved only if all messages before it are parsed
+    save_uidnext = criteria is None or criteria.lower() == 'all'
     uidnext = 1
     if criteria is None:
         saved = data_uidnext.get()
@@ -681,49 +1390,263 @@ def parse(criteria=None, con=None, **opts):
             clean_parsed_msgs(puids, con=con)
 
     uids = imap.Uids(uids, **opts)
-    puids = list(uids.call_async(parse_msgs, uids))
+    inflight = inflight_mb and inflight_mb * 2 ** 20 // uids.threads
+    if procs:
+        ctx = multiprocessing.get_context('spawn')
+        with futures.ProcessPoolExecutor(procs, mp_context=ctx) as pool:
+            puids = list(uids.call_async(parse_msgs, uids, pool, inflight))
+    else:
+        puids = list(uids.call_async(parse_msgs, uids, None, inflight))
     log.info('## parsed %s messages', len(puids))
 
-    data_uidnext(uidnext)
+    if save_uidnext:
+        data_uidnext(uidnext)
     update_metadata('%s:*' % parsed_uidnext)
 
     sieve_run('UID %s' % uids.str, sieve_scripts('auto'))
 
 
-@metadata('threads', lambda: [{}, {}])
+@fn_time
+@using()
+def parse_stale(batch=1000, con=None, **opts):
+    """Parse again messages parsed by previous versions of the parser
+
+    It goes by small chunks, so only few messages are missing in "ALL"
+    at the same time and it could be stopped any moment. New messages
+    are parsed between chunks, so they aren't delayed by the long run.
+    """
+    parse(batch=batch, **opts)
+
+    version = '<%s>' % message.VERSION
+    puids = con.search('UNDELETED NOT HEADER X-Parser-Version %s' % version)
+    uids = pair_parsed_uids(puids)
+    log.info('## %s messages parsed by previous versions', len(uids))
+    for i in range(0, len(uids), batch):
+        parse('UID %s' % ','.join(uids[i:i + batch]), batch=batch, **opts)
+        parse(batch=batch, **opts)
+
+
+@metadata('threads', threads_codec, shard=10000, codec=threads_codec)
 def data_threads(thrids, thrs):
     return [thrids, thrs]
 
 
+@metadata('recency', recency_codec, journal=100, codec=recency_codec)
+def data_recency(times):
+    """Thread ids with arrival time of the latest message"""
+    return times
+
+
+def update_recency(thrs, delta):
+    recency = data_recency.get()
+    size = len(recency) + sum(
+        (v is not None and i not in recency) - (v is None and i in recency)
+        for i, v in delta.items()
+    )
+    if size == len(thrs):
+        data_recency.update(delta)
+        return
+
+    log.info('## rebuild index of threads by recency')
+    msgs = data_msgs.many(list(thrs))
+    data_recency({i: msgs[i]['arrived'] for i in thrs})
+
+
+@metadata('refs', lambda: {}, journal=100)
+def data_refs(refs):
+    """References graph: message-id to its parent"""
+    return refs
+
+
+@metadata('refroots', lambda: {}, journal=100)
+def data_refroots(roots):
+    """Top of references graph to thread id"""
+    return roots
+
+
+def refs_root(refs, mid):
+    seen = set()
+    while mid in refs and mid not in seen:
+        seen.add(mid)
+        mid = refs[mid]
+    return mid
+
+
+def refs_link(refs, chain):
+    """Link references chain like JWZ algorithm does
+
+    A reference keeps the first parent it got, but a message always gets
+    the last reference as a parent.
+    """
+    for parent, child in zip(chain, chain[1:]):
+        if child in refs and child != chain[-1]:
+            continue
+        if refs_root(refs, parent) == child:
+            # no loops
+            continue
+        refs[child] = parent
+
+
+def refs_node(msgs, mids, uid):
+    """Node of the message in references graph
+
+    Like RFC 5256 says, only the first message keeps a duplicated
+    message-id, others (and messages without "Message-ID") are unique.
+    """
+    mid = msgs[uid]['msgid']
+    if mid != message.NOID and mids.get(mid, [uid])[0] == uid:
+        return mid
+    return '%s:%s' % (mid, uid)
+
+
+def refs_parse(data):
+    return data.decode().split(':', 1)[-1].split()
+
+
 @using()
-@lock.user_scope('update_threads')
-def update_threads(uids, thrids=None, thrs=None, con=None):
-    if thrids is None:
-        thrids, thrs = data_threads.get()
+def refs_fetch(uids, con=None):
+    res = con.fetch(uids, '(UID BODY.PEEK[HEADER.FIELDS (References)])')
+    refs = {}
+    for i in range(0, len(res), 2):
+        uid = re.search(r'UID (\d+)', res[i][0].decode()).group(1)
+        refs[uid] = refs_parse(res[i][1])
+    return refs
 
-    if not isinstance(uids, str):
-        uids = ','.join(uids)
 
-    orig_thrs = con.thread('REFS UTF-8 INTHREAD REFS UID %s' % uids)
-    if not orig_thrs:
+@using()
+@metadata_txn()
+@metadata_lock('update_threads')
+def update_threads(uids, refs=None, con=None):
+    """Update threads of messages by references graph
+
+    "refs" are references of new messages (the same as in parsed message),
+    they are linked into the graph and only affected threads are rebuilt.
+    Dovecot "THREAD" is used only for full rebuild.
+    """
+    full = uids == '1:*'
+    graph = data_refs.get()
+    if not full and data_threads.get()[0] and not graph:
+        log.info('## no references graph yet, rebuild all threads')
+        full, uids, refs = True, '1:*', None
+    elif not full and message.NOID in graph:
+        log.info('## outdated references graph, rebuild all threads')
+        full, uids, refs = True, '1:*', None
+
+    if refs is None and (full or isinstance(uids, str)):
+        refs = refs_fetch(uids, con=con)
+        uids = list(refs)
+    if full:
+        return rebuild_threads(refs, con=con)
+
+    refs = refs or {}
+    thrids, thrs = data_threads.edit()
+    msgs = data_msgs.many(uids)
+    uids = sorted((i for i in uids if i in msgs), key=lambda i: int(i))
+    if not uids:
         log.info('## no threads are updated')
         return
 
-    all_uids = set(orig_thrs.all_uids)
+    graph = ChainMap({}, graph)
+    roots = ChainMap({}, data_refroots.get())
+    node = ft.partial(refs_node, msgs, data_msgids.get())
+
+    def thread(mid):
+        thrid = roots.get(refs_root(graph, mid))
+        return thrid if thrid and thrid in thrs else None
+
+    found, tops = set(), set()
+    for uid in uids:
+        chain = refs.get(uid, []) + [node(uid)]
+        tops.update(refs_root(graph, i) for i in chain)
+        refs_link(graph, chain)
+        found.update(thread(i) for i in chain)
+        if uid in thrids:
+            found.add(thrids[uid])
+    found.update(roots.get(i) for i in tops)
+    found = set(i for i in found if i and i in thrs)
+
+    all_uids = set(uids).union(*(thrs[i] for i in found))
+    msgs.update(data_msgs.many(all_uids.difference(msgs)))
+    links = links_get()
+    linked = set(links_find(links, msgs[i]['msgid']) for i in all_uids)
+    linked = [
+        set(sum(data_msgids.many(links_members(links, i)).values(), []))
+        for i in linked.difference([None])
+    ]
+    for link in linked:
+        link_thrids = set(thrids[i] for i in link if i in thrids)
+        found.update(link_thrids)
+        all_uids.update(link, *(thrs[i] for i in link_thrids))
+    msgs.update(data_msgs.many(all_uids.difference(msgs)))
+    all_uids.intersection_update(msgs)
+
+    # group messages by top of the graph, linked groups are joined
+    joined = {}
+
+    def top(uid):
+        top = refs_root(graph, node(uid))
+        while top in joined:
+            top = joined[top]
+        return top
+
+    for link in linked:
+        few = set(top(i) for i in link if i in all_uids)
+        first = few and few.pop()
+        joined.update((i, first) for i in few)
+    groups = {}
+    for uid in all_uids:
+        groups.setdefault(top(uid), []).append(uid)
+
+    recency = {}
+    for thrid in found:
+        for uid in thrs.pop(thrid):
+            thrids.pop(uid, None)
+        recency[thrid] = None
+    for few in groups.values():
+        few = sorted(few, key=lambda i: (msgs[i]['arrived'], int(i)))
+        thrid = few[-1]
+        for uid in few:
+            thrids[uid] = thrid
+        thrs[thrid] = few
+        recency[thrid] = msgs[thrid]['arrived']
+    for uid in all_uids:
+        i = refs_root(graph, node(uid))
+        tops.discard(i)
+        if roots.get(i) != thrids[uid]:
+            roots[i] = thrids[uid]
+    for i in tops:
+        if roots.get(i):
+            roots[i] = None
+
+    data_refs.update(graph.maps[0])
+    data_refroots.update(roots.maps[0])
+    data_threads(thrids, thrs)
+    update_recency(thrs, recency)
+    update_tagcounts(list(recency), con=con)
+    log.info('updated %s threads', len(groups))
+
+
+@using()
+def rebuild_threads(refs, con=None):
+    orig_thrs = con.thread('REFS UTF-8 INTHREAD REFS UID 1:*')
+    if not orig_thrs:
+        log.info('## no threads are updated')
+        return
 
+    thrids, thrs = {}, {}
     msgs = data_msgs.get()
     mids = data_msgids.get()
 
     all_links = []
     linked_uids = set()
-    for link in data_links.get():
-        uids = sum((mids.get(mid, []) for mid in link), [])
-        if not all_uids.intersection(uids):
+    links = links_get()
+    for link in links.values():
+        if not isinstance(link, list):
             continue
+        uids = sum((mids.get(mid, []) for mid in link), [])
         all_links.append(uids)
         linked_uids.update(uids)
 
-    updated = set()
     for uids in orig_thrs:
         uids_set = set(uids)
         if uids_set.intersection(linked_uids):
@@ -735,18 +1658,32 @@ def update_threads(uids, thrids=None, thrs=None, con=None):
         previous_uids = (thrs[uid] for uid in previous_thrids if thrs.get(uid))
         previous_uids = sum(previous_uids, [])
         uids = set(previous_uids).union(uids)
-        uids = sorted(uids, key=lambda i: msgs[i]['arrived'])
+        uids = sorted(uids, key=lambda i: (msgs[i]['arrived'], int(i)))
         thrid = uids[-1]
         for uid in uids:
             thrids[uid] = thrid
             if uid == thrid:
                 thrs[uid] = uids
-                updated.add(uid)
             elif uid in thrs:
                 del thrs[uid]
 
+    graph = {}
+    node = ft.partial(refs_node, msgs, mids)
+    for uid in sorted(refs, key=lambda i: int(i)):
+        if uid in msgs:
+            refs_link(graph, refs[uid] + [node(uid)])
+    roots = {}
+    for thrid, uids in thrs.items():
+        for uid in uids:
+            roots[refs_root(graph, node(uid))] = thrid
+
+    data_refs(graph)
+    data_refroots(roots)
     data_threads(thrids, thrs)
-    log.info('updated %s threads', len(updated))
+    data_recency({i: msgs[i]['arrived'] for i in thrs})
+    if data_tagcounts.get():
+        data_tagcounts.unset()
+    log.info('updated %s threads', len(thrs))
 
 
 @fn_time
@@ -933,6 +1870,16 @@ def search_msgs(query, sort='(REVERSE ARRIVAL)', con=None):
     return uids
 
 
+@fn_time
+@using()
+def search_msgs_page(query, limit, offset=0, con=None):
+    """Page of found messages and total count, only the page is sent back"""
+    sort = '(REVERSE ARRIVAL)'
+    uids, total = con.sort_partial(sort, query, offset + 1, offset + limit)
+    log.debug('query: %r; messages: %s', query, total)
+    return uids, total
+
+
 @fn_time
 @using()
 def msgs_info(uids, con=None):
@@ -947,9 +1894,26 @@ def msgs_info(uids, con=None):
 @fn_time
 @using()
 def msgs_body(uids, fix_privacy=False, con=None):
-    msgs = data_msgs.get()
+    """Bodies ready for rendering, cached ones aren't fetched again
+
+    Body of parsed message never changes, so a key of the cache is
+    UIDVALIDITY and uid. Drafts are rendered every time.
+    """
+    msgs = data_msgs.many(uids)
     drafts = data_drafts.get()
-    res = con.fetch(uids, '(UID BINARY.PEEK[2.1])')
+    only_proxy = not fix_privacy
+    keys = {uid: body_key(uid, only_proxy, con) for uid in uids}
+    fetch = []
+    for uid in uids:
+        body = cache.get(keys[uid])
+        if body is None:
+            fetch.append(uid)
+            continue
+        yield uid, body
+    if not fetch:
+        return
+
+    res = con.fetch(fetch, '(UID BINARY.PEEK[2.1])')
     for i in range(0, len(res), 2):
         uid = res[i][0].decode().split()[2]
         if uid not in msgs:
@@ -963,13 +1927,33 @@ def msgs_body(uids, fix_privacy=False, con=None):
             )
         else:
             body = res[i][1].decode()
-        body = html.fix_privacy(body, only_proxy=not fix_privacy)
+        body = html.fix_privacy(body, only_proxy, cleaned=not draft_id)
+        if not draft_id:
+            cache.set(keys[uid], body)
         yield uid, body
 
 
+def body_key(uid, only_proxy, con):
+    kind = 'proxy' if only_proxy else 'privacy'
+    return 'body/%s/%s/%s' % (con.uidvalidity, kind, uid)
+
+
+@fn_time
+@using()
+def search_thrs(query, limit=None, con=None):
+    """Thread ids of found messages, the latest first"""
+    return thrs_latest(found_thrs(query, con=con), limit)
+
+
 @fn_time
 @using()
-def search_thrs(query, con=None):
+def search_thrs_page(query, limit, offset=0, con=None):
+    """Page of found threads and total count"""
+    found = found_thrs(query, con=con)
+    return thrs_latest(found, limit, offset), len(found)
+
+
+def found_thrs(query, con):
     q = [query] if isinstance(query, str) else query.copy()
     if len(q) > 1:
         uids = []
@@ -982,12 +1966,45 @@ def search_thrs(query, con=None):
     else:
         uids = con.search(q[0])
     if uids:
-        msgs = data_msgs.get()
         thrids, thrs = data_threads.get()
         uids = set(thrids[uid] for uid in uids if uid in thrids)
-        uids = sorted(uids, key=lambda uid: msgs[uid]['arrived'], reverse=True)
     log.debug('query: %r; threads: %s', query, len(uids))
-    return uids
+    return set(uids)
+
+
+def thrs_latest(thrids, limit=None, offset=0):
+    """Thread ids ordered by index, it's scanned only for first "limit" ones"""
+    end = offset + limit if limit else None
+    recency = data_recency.get()
+    if len(recency) != len(data_threads.get()[1]):
+        # index isn't built yet
+        return thrs_arrived(thrids)[offset:end]
+    elif end and len(thrids) > end:
+        found = []
+        for i in recency.latest():
+            if i in thrids:
+                found.append(i)
+                if len(found) == end:
+                    return found[offset:]
+        log.warning('## index of threads by recency is out of date')
+        return thrs_arrived(thrids)[offset:end]
+
+    try:
+        thrids = sorted(
+            thrids, key=lambda i: (recency[i], int(i)), reverse=True
+        )
+    except KeyError:
+        log.warning('## index of threads by recency is out of date')
+        return thrs_arrived(thrids)[offset:end]
+    return thrids[offset:end]
+
+
+def thrs_arrived(thrids):
+    """Thread ids ordered by arrival time of the latest message"""
+    msgs = data_msgs.many(thrids)
+    return sorted(
+        thrids, key=lambda i: (msgs[i]['arrived'], int(i)), reverse=True
+    )
 
 
 @fn_time
@@ -1031,8 +2048,7 @@ def thrs_info(uids, tags=None, con=None):
                 continue
             elif special_tag and special_tag not in msg_flags:
                 continue
-            info = msgs[uid]
-            info['uid'] = uid
+            info = dict(msgs[uid], uid=uid)
             addrs.append(info.get('from'))
             if '\\Seen' not in msg_flags:
                 unseen = True
@@ -1,20 +1,32 @@
+import codecs
 import datetime as dt
 import email
+import email.feedparser
 import email.header
+import email.message
 import email.policy
 import encodings
 import hashlib
 import json
 import mimetypes
 import re
+import tempfile
 import uuid
 from email.message import MIMEPart
-from email.utils import formatdate, getaddresses, parsedate_to_datetime
+from email.utils import (
+    formatdate, getaddresses, parseaddr, parsedate_to_datetime
+)
 
 import chardet
 
 from . import conf, html, log
 
+# should be increased on changes of "parsed" result
+VERSION = 3
+
+# message-id for messages without "Message-ID" header
+NOID = '<mailur@noid>'
+
 aliases = {
     # Seems Google used gb2312 in some subjects, so there is another symbol
     # instead of dash, because of next bug:
@@ -60,7 +72,189 @@ def binary(txt, mimetype='text/plain'):
     return msg
 
 
-def parse_mime(orig, uid):
+DETECT_SIZE = 2 ** 16
+
+
+# chardet less sure than that just guesses, so a learned hint is better
+CHARDET_CONFIDENCE = 0.3
+# candidates closer than that to the best one are a tie
+CHARDET_TIE = 0.05
+
+
+def detect_utf8(raw):
+    try:
+        raw.decode()
+    except UnicodeDecodeError:
+        return None
+    return 'utf-8'
+
+
+def same_charset(one, two):
+    try:
+        return codecs.lookup(one).name == codecs.lookup(two).name
+    except LookupError:
+        return False
+
+
+def detect_chardet(raw, hints):
+    # the beginning is enough, but it's much faster for big parts
+    found = chardet.detect_all(raw[:DETECT_SIZE])
+    found = [(i['encoding'], i['confidence']) for i in found if i['encoding']]
+    if not found:
+        return None, None
+
+    charset, confidence = found[0]
+    for hint in hints:
+        if confidence < CHARDET_CONFIDENCE:
+            try:
+                raw.decode(hint)
+            except (UnicodeDecodeError, LookupError):
+                continue
+            return 'hints', hint
+
+        tie = (
+            same_charset(hint, name)
+            for name, conf in found if conf >= confidence - CHARDET_TIE
+        )
+        if any(tie):
+            return 'hints', hint
+    return 'chardet', charset.lower()
+
+
+def detect_charset(raw, hints=()):
+    """Name of the detector and charset found by it
+
+    "hints" are charsets learned from previous messages of the sender,
+    they are used only for ties or guesses of chardet, because
+    single-byte charsets decode anything.
+    """
+    if detect_utf8(raw):
+        return 'utf8', 'utf-8'
+    return detect_chardet(raw, hints)
+
+
+# bigger messages are parsed by chunks
+STREAM_SIZE = 2 ** 25
+# bigger payloads of attachments are spilled to disk then
+SPILL_SIZE = 2 ** 20
+CHUNK_SIZE = 2 ** 16
+
+
+class SpilledMessage(email.message.Message):
+    """Message with big payloads of attachments in temporary files
+
+    Payload is read back by "get_payload" only. The last line ending
+    stays in memory, parser cuts it before a boundary.
+    """
+    spilled = None
+
+    def set_payload(self, payload, charset=None):
+        self.spilled = None
+        big = (
+            charset is None and isinstance(payload, str) and
+            len(payload) > SPILL_SIZE and
+            self.get_content_maintype() != 'text'
+        )
+        if big:
+            eol = email.feedparser.NLCRE_eol.search(payload)
+            end = eol.start() if eol else len(payload)
+            self.spilled = tempfile.TemporaryFile()
+            for i in range(0, end, CHUNK_SIZE):
+                chunk = payload[i:min(i + CHUNK_SIZE, end)]
+                self.spilled.write(chunk.encode('ascii', 'surrogateescape'))
+            payload = payload[end:]
+        super().set_payload(payload, charset)
+
+    def get_payload(self, i=None, decode=False):
+        if self.spilled:
+            self.spilled.seek(0)
+            payload = self.spilled.read().decode('ascii', 'surrogateescape')
+            self.spilled = None
+            super().set_payload(payload + self._payload)
+        return super().get_payload(i, decode)
+
+    def payload_chunks(self):
+        self.spilled.seek(0)
+        for line in iter(lambda: self.spilled.readline(CHUNK_SIZE), b''):
+            yield line.decode('ascii', 'surrogateescape')
+        yield self._payload
+
+
+def from_bytes(raw):
+    """The same as "email.message_from_bytes", but big messages are
+    fed to the parser by chunks and payloads of their attachments are
+    spilled to disk
+    """
+    if len(raw) < STREAM_SIZE:
+        return email.message_from_bytes(raw)
+
+    parser = email.feedparser.BytesFeedParser(_factory=SpilledMessage)
+    raw = memoryview(raw)
+    for i in range(0, len(raw), CHUNK_SIZE):
+        parser.feed(bytes(raw[i:i + CHUNK_SIZE]))
+    return parser.close()
+
+
+def payload_chunks(part):
+    """Encoded payload, it's read by lines if it's spilled to disk"""
+    if getattr(part, 'spilled', None):
+        return part.payload_chunks()
+    return [part.get_payload()]
+
+
+def encoded_size(part):
+    """Size of the part with headers, it's close to "len(part.as_bytes())"
+
+    It's counted by parts, so nothing is serialized.
+    """
+    size = sum(len(k) + len(v) + 3 for k, v in part.items()) + 1
+    payload = part.get_payload() if part.is_multipart() else None
+    if not isinstance(payload, list):
+        return size + sum(len(i) for i in payload_chunks(part))
+
+    boundary = part.get_boundary()
+    if boundary is None:
+        return size + sum(encoded_size(i) for i in payload)
+    size += sum(len(boundary) + 4 + encoded_size(i) for i in payload)
+    return size + len(boundary) + 5
+
+
+def decoded_size(part):
+    """Size of decoded payload, it's counted by encoded one
+
+    So big attachments aren't decoded just to get their sizes.
+    """
+    if part.is_multipart():
+        return encoded_size(part)
+
+    cte = str(part.get('content-transfer-encoding', '')).strip().lower()
+    if cte == 'base64':
+        # decoder skips line breaks, spaces and padding
+        size = sum(
+            len(i) - sum(i.count(c) for c in '\r\n\t =')
+            for i in payload_chunks(part)
+        )
+        return size * 3 // 4
+    elif cte == 'quoted-printable':
+        size = 0
+        for i in payload_chunks(part):
+            soft = i.count('=\r\n') * 3 + i.count('=\n') * 2
+            escaped = sum(1 for m in re.finditer('=[0-9A-Fa-f]{2}', i))
+            size += len(i) - soft - escaped * 2
+        return size
+    elif cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+        return len(part.get_payload(decode=True) or b'')
+    elif getattr(part, 'spilled', None):
+        # undecodable bytes are kept as surrogates, one per byte
+        return sum(len(i) for i in payload_chunks(part))
+
+    payload = part.get_payload()
+    if not payload.isascii():
+        return len(part.get_payload(decode=True))
+    return len(payload)
+
+
+def parse_mime(orig, uid, hints=None):
     def error(e, label):
         return 'error on %r: [%s] %s' % (label, e.__class__.__name__, e)
 
@@ -93,11 +287,9 @@ def parse_mime(orig, uid):
             if txt:
                 return txt
 
-            # trying chardet
-            detected = chardet.detect(raw)
-            charset = detected['encoding']
+            detector, charset = detect_charset(raw, sender_hints)
             if charset:
-                charset = charset.lower()
+                detected.append([detector, charset])
             else:
                 charset = charsets[0] if charsets else 'utf8'
 
@@ -141,10 +333,10 @@ def parse_mime(orig, uid):
             parts.append(('"%s" <%s>' % (name, addr)) if name else addr)
         return ', '.join(p for p in parts if p)
 
-    def attachment(part, content, path):
+    def attachment(part, size, path):
         ctype = part.get_content_type()
         label = '%s(%s)' % (ctype, path)
-        item = {'size': len(content), 'path': path}
+        item = {'size': size, 'path': path}
         filename = part.get_filename()
         if filename:
             filename = decode_header(part.get_filename(), label) or ''
@@ -167,12 +359,10 @@ def parse_mime(orig, uid):
         htm, txt, files = '', '', []
         ctype = part.get_content_type()
         if ctype.startswith('message/'):
-            content = part.as_bytes()
-            files = [attachment(part, content, path)]
+            files = [attachment(part, encoded_size(part), path)]
             return htm, txt, files
         elif part.get_filename():
-            content = part.get_payload(decode=True)
-            files = [attachment(part, content, path)]
+            files = [attachment(part, decoded_size(part), path)]
             return htm, txt, files
         elif part.is_multipart():
             idx, parts = 0, []
@@ -212,12 +402,13 @@ def parse_mime(orig, uid):
             else:
                 txt = content
         else:
-            content = part.get_payload(decode=True)
-            files = [attachment(part, content, path)]
+            files = [attachment(part, decoded_size(part), path)]
         return htm, txt, files
 
     charsets = list(set(c.lower() for c in orig.get_charsets() if c))
-    errors, headers = [], {}
+    sender = parseaddr(str(orig['From'] or ''))[1].lower()
+    sender_hints = [hints[sender]] if hints and sender in hints else []
+    errors, headers, detected = [], {}, []
     htm, txt, files = parse_part(orig)
 
     for n in ('From', 'Sender', 'Reply-To', 'To', 'CC', 'BCC',):
@@ -227,16 +418,16 @@ def parse_mime(orig, uid):
         headers[n] = v
 
     headers['Subject'] = decode_header(orig['subject'], 'Subject')
-    return htm, txt, files, headers, errors
+    return htm, txt, files, headers, errors, detected
 
 
 def normalize_msgid(mid):
     return mid.strip().lower()
 
 
-def preview(htm, files):
+def preview(htm, files, txt=None):
     htm = htm.strip()
-    preview = html.to_line(htm, 200) if htm else ''
+    preview = html.to_line(htm, 200, txt) if htm else ''
     if len(preview) < 200 and files:
         preview += (' ' if preview else '') + (
             '[%s]' % ', '.join(f['filename'] for f in files)
@@ -244,24 +435,37 @@ def preview(htm, files):
     return preview
 
 
-def parsed(raw, uid, time, flags):
-    # "email.message_from_bytes" uses "email.policy.compat32" policy
+def sender(raw):
+    """Address from "From" header, only headers are parsed"""
+    end = re.search(br'\r?\n\r?\n', raw)
+    orig = email.message_from_bytes(raw[:end.start()] if end else raw)
+    return parseaddr(str(orig['From'] or ''))[1].lower()
+
+
+def parsed(raw, uid, time, flags, hints=None):
+    # "from_bytes" uses "email.policy.compat32" policy
     # and it's by intention, because new policies don't work well
     # with real emails which have no encodings, badly formated addreses, etc.
-    orig = email.message_from_bytes(raw)
-    htm, txt, files, headers, errors = parse_mime(orig, uid)
-    meta = {'origin_uid': uid, 'files': [], 'errors': errors}
+    orig = from_bytes(raw)
+    htm, txt, files, headers, errors, detected = parse_mime(orig, uid, hints)
+    meta = {
+        'origin_uid': uid, 'parser_version': VERSION,
+        'files': [], 'errors': errors
+    }
+    if detected:
+        meta['detected'] = detected
+    htm_txt = None
     if htm:
         embeds = {
             f['content-id']: f['url']
             for f in files if 'content-id' in f
         }
-        htm, extra_meta = html.clean(htm, embeds)
+        htm, extra_meta, htm_txt = html.clean(htm, embeds)
         meta.update(extra_meta)
     elif txt:
         htm = html.from_text(txt)
 
-    meta['preview'] = preview(htm, files)
+    meta['preview'] = preview(htm, files, htm_txt)
     meta['files'] = files
 
     fields = (
@@ -291,7 +495,7 @@ def parsed(raw, uid, time, flags):
     mid = orig['message-id']
     if mid is None:
         log.info('UID=%s has no "Message-ID" header', uid)
-        mid = '<mailur@noid>'
+        mid = NOID
     else:
         mid = normalize_msgid(mid)
     meta['msgid'] = mid
@@ -349,6 +553,7 @@ def parsed(raw, uid, time, flags):
     if refs:
         msg.add_header('In-Reply-To', refs[-1])
         msg.add_header('References', ' '.join(refs))
+    msg.add_header('X-Parser-Version', '<%s>' % VERSION)
 
     msg.make_mixed()
     meta_txt = json.dumps(meta, sort_keys=True, ensure_ascii=False, indent=2)
@@ -366,6 +571,12 @@ def parsed(raw, uid, time, flags):
     return msg, flags
 
 
+def parsed_bytes(raw, uid, time, flags, hints=None):
+    """The same as "parsed", but result is bytes (for worker processes)"""
+    msg, marks = parsed(raw, uid, time, flags, hints)
+    return msg.as_bytes(), marks
+
+
 def sending(msg, linesep='\r\n', maxlinelen=70):
     def _fold(v, name=None):
         try:
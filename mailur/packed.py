@@ -0,0 +1,394 @@
+"""Compact dict-like containers for uid based metadata
+
+Uids are kept in sorted "array('I')", so big maps (like "thrids",
+"thrs" or "uidpairs") take few bytes per item and are saved as is
+instead of JSON.
+"""
+import bisect
+import sys
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+from . import json
+
+MAGIC = b'MLRP1' + sys.byteorder[0].encode()
+
+
+def ids(items=()):
+    return array('I', items)
+
+
+def to_int(key):
+    try:
+        return int(key)
+    except (TypeError, ValueError):
+        raise KeyError(key)
+
+
+class UidMap(MutableMapping):
+    """Uid to uid map"""
+    kind = 1
+
+    def __init__(self, items=None):
+        self._keys = ids()
+        self._vals = ids()
+        if items:
+            self.update(items)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def _index(self, key):
+        key = to_int(key)
+        i = bisect.bisect_left(self._keys, key)
+        return key, i, i < len(self._keys) and self._keys[i] == key
+
+    def __getitem__(self, key):
+        key, i, found = self._index(key)
+        if not found:
+            raise KeyError(key)
+        return str(self._vals[i])
+
+    def __setitem__(self, key, value):
+        key, i, found = self._index(key)
+        if found:
+            self._vals[i] = int(value)
+        else:
+            self._keys.insert(i, key)
+            self._vals.insert(i, int(value))
+
+    def __delitem__(self, key):
+        key, i, found = self._index(key)
+        if not found:
+            raise KeyError(key)
+        del self._keys[i]
+        del self._vals[i]
+
+    def __iter__(self):
+        return (str(i) for i in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, other=(), **kw):
+        if isinstance(other, UidMap):
+            items = list(zip(other._keys, other._vals))
+        else:
+            items = other.items() if hasattr(other, 'items') else other
+            items = sorted((int(k), int(v)) for k, v in items)
+        items += [(int(k), int(v)) for k, v in sorted(kw.items())]
+        if not items:
+            return
+        elif not self._keys or items[0][0] > self._keys[-1]:
+            # the most common case: merging of shards
+            self._keys.extend(k for k, v in items)
+            self._vals.extend(v for k, v in items)
+            return
+
+        merged = dict(zip(self._keys, self._vals))
+        merged.update(items)
+        keys = sorted(merged)
+        self._keys = ids(keys)
+        self._vals = ids(merged[k] for k in keys)
+
+    def copy(self):
+        value = self.__class__()
+        value._keys = self._keys[:]
+        value._vals = self._vals[:]
+        return value
+
+    def dump(self):
+        return ids([len(self._keys)]) + self._keys + self._vals
+
+    @classmethod
+    def load(cls, data, pos):
+        size = data[pos]
+        pos += 1
+        value = cls()
+        value._keys = data[pos:pos + size]
+        value._vals = data[pos + size:pos + size * 2]
+        return value, pos + size * 2
+
+
+class UidLists(MutableMapping):
+    """Uid to list of uids map
+
+    Changes are kept in "changed" dict until the next "dump".
+    """
+    kind = 2
+
+    def __init__(self, items=None):
+        self._keys = ids()
+        self._starts = ids([0])
+        self._flat = ids()
+        self._changed = {}
+        self._len = 0
+        if items:
+            self.update(items)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def _base(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            start, end = self._starts[i], self._starts[i + 1]
+            return [str(uid) for uid in self._flat[start:end]]
+        return None
+
+    def _get(self, key):
+        if key in self._changed:
+            return self._changed[key]
+        return self._base(key)
+
+    def __getitem__(self, key):
+        value = self._get(to_int(key))
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        key = to_int(key)
+        if self._get(key) is None:
+            self._len += 1
+        self._changed[key] = [str(i) for i in value]
+
+    def __delitem__(self, key):
+        key = to_int(key)
+        if self._get(key) is None:
+            raise KeyError(key)
+        self._changed[key] = None
+        self._len -= 1
+
+    def __iter__(self):
+        for key in self._keys:
+            if self._changed.get(key, True) is not None:
+                yield str(key)
+        base = set(self._keys)
+        for key, value in self._changed.items():
+            if value is not None and key not in base:
+                yield str(key)
+
+    def __len__(self):
+        return self._len
+
+    def update(self, other=(), **kw):
+        simple = (
+            isinstance(other, UidLists) and not kw and
+            not self._changed and not other._changed and
+            (not self._keys or not other._keys or
+             other._keys[0] > self._keys[-1])
+        )
+        if not simple:
+            return super().update(other, **kw)
+
+        # the most common case: merging of shards
+        shift = len(self._flat)
+        self._keys.extend(other._keys)
+        self._starts.extend(i + shift for i in other._starts[1:])
+        self._flat.extend(other._flat)
+        self._len += other._len
+
+    def copy(self):
+        value = self.__class__()
+        value._keys = self._keys[:]
+        value._starts = self._starts[:]
+        value._flat = self._flat[:]
+        value._changed = dict(self._changed)
+        value._len = self._len
+        return value
+
+    def compact(self):
+        if not self._changed:
+            return
+        keys = sorted(int(i) for i in self)
+        values = [self._get(k) for k in keys]
+        self._keys = ids(keys)
+        self._starts = ids([0])
+        self._flat = ids()
+        for value in values:
+            self._flat.extend(int(i) for i in value)
+            self._starts.append(len(self._flat))
+        self._changed = {}
+
+    def dump(self):
+        self.compact()
+        size = len(self._keys)
+        return ids([size]) + self._keys + self._starts + self._flat
+
+    @classmethod
+    def load(cls, data, pos):
+        size = data[pos]
+        pos += 1
+        value = cls()
+        value._keys = data[pos:pos + size]
+        pos += size
+        value._starts = data[pos:pos + size + 1]
+        pos += size + 1
+        flat_size = value._starts[-1]
+        value._flat = data[pos:pos + flat_size]
+        value._len = size
+        return value, pos + flat_size
+
+
+class UidTimes(MutableMapping):
+    """Uid to time map, ordered by time as well
+
+    "latest()" goes from the latest time, so there is no sorting on read.
+    """
+    kind = 3
+
+    def __init__(self, items=None):
+        self._keys = ids()
+        self._vals = ids()
+        self._order = array('Q')
+        if items:
+            self.update(items)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def _index(self, key):
+        key = to_int(key)
+        i = bisect.bisect_left(self._keys, key)
+        return key, i, i < len(self._keys) and self._keys[i] == key
+
+    def __getitem__(self, key):
+        key, i, found = self._index(key)
+        if not found:
+            raise KeyError(key)
+        return self._vals[i]
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        key, i, found = self._index(key)
+        self._keys.insert(i, key)
+        self._vals.insert(i, int(value))
+        order = int(value) << 32 | key
+        self._order.insert(bisect.bisect_left(self._order, order), order)
+
+    def __delitem__(self, key):
+        key, i, found = self._index(key)
+        if not found:
+            raise KeyError(key)
+        order = self._vals[i] << 32 | key
+        del self._order[bisect.bisect_left(self._order, order)]
+        del self._keys[i]
+        del self._vals[i]
+
+    def __iter__(self):
+        return (str(i) for i in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, other=(), **kw):
+        if self:
+            return super().update(other, **kw)
+
+        items = other.items() if hasattr(other, 'items') else other
+        items = dict((int(k), int(v)) for k, v in items)
+        items.update((int(k), int(v)) for k, v in kw.items())
+        keys = sorted(items)
+        self._keys = ids(keys)
+        self._vals = ids(items[k] for k in keys)
+        self._order = array('Q', sorted(v << 32 | k for k, v in items.items()))
+
+    def latest(self):
+        return (str(i & 0xffffffff) for i in reversed(self._order))
+
+    def copy(self):
+        value = self.__class__()
+        value._keys = self._keys[:]
+        value._vals = self._vals[:]
+        value._order = self._order[:]
+        return value
+
+    def dump(self):
+        order = ids()
+        order.frombytes(self._order.tobytes())
+        return ids([len(self._keys)]) + self._keys + self._vals + order
+
+    @classmethod
+    def load(cls, data, pos):
+        size = data[pos]
+        pos += 1
+        value = cls()
+        value._keys = data[pos:pos + size]
+        value._vals = data[pos + size:pos + size * 2]
+        pos += size * 2
+        value._order = array('Q')
+        value._order.frombytes(data[pos:pos + size * 2].tobytes())
+        return value, pos + size * 2
+
+
+TYPES = (UidMap, UidLists, UidTimes)
+
+
+class View(Mapping):
+    """Read-only view of the container"""
+    def __init__(self, value):
+        self._value = value
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._value)
+
+    def __getitem__(self, key):
+        return self._value[key]
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def __len__(self):
+        return len(self._value)
+
+    def latest(self):
+        return self._value.latest()
+
+
+class Codec:
+    """Saves value (one container or list of them) as binary data
+
+    Value could be plain dict, it's converted to the container then.
+    """
+    mimetype = 'application/octet-stream'
+    kinds = {i.kind: i for i in TYPES}
+
+    def __init__(self, *types):
+        self.types = types
+
+    def __call__(self):
+        """Empty value"""
+        value = [t() for t in self.types]
+        return value if len(value) > 1 else value[0]
+
+    def convert(self, value):
+        items = value if len(self.types) > 1 else [value]
+        items = [
+            i if isinstance(i, t) else t(i)
+            for t, i in zip(self.types, items)
+        ]
+        return items if len(items) > 1 else items[0]
+
+    def dumps(self, value):
+        items = self.convert(value)
+        items = items if len(self.types) > 1 else [items]
+        data = ids([len(items)])
+        for item in items:
+            data += ids([item.kind]) + item.dump()
+        return MAGIC + data.tobytes()
+
+    def loads(self, data):
+        if not data.startswith(MAGIC):
+            # saved as JSON before
+            return self.convert(json.loads(data.decode()))
+
+        data, raw = ids(), data
+        data.frombytes(raw[len(MAGIC):])
+        pos, items = 1, []
+        for i in range(data[0]):
+            kind = self.kinds[data[pos]]
+            item, pos = kind.load(data, pos + 1)
+            items.append(item)
+        return items if len(items) > 1 else items[0]
@@ -32,18 +32,23 @@ def data_account(value):
     return value
 
 
-@local.setting('remote/uidnext', lambda: {})
+@local.setting('remote/uidnext', lambda: {}, journal=100)
 def data_uidnext(key, value):
-    setting = data_uidnext.get()
-    setting[key] = value
-    return setting
+    return {key: value}
 
 
-@local.setting('remote/modseq', lambda: {})
+@local.setting('remote/modseq', lambda: {}, journal=100)
 def data_modseq(key, value):
-    setting = data_modseq.get()
-    setting[key] = value
-    return setting
+    return {key: value}
+
+
+@local.setting('remote/sha256', lambda: {}, journal=1000)
+def data_sha256(delta):
+    """Uids of fetched messages by their hashes
+
+    "uidnext" key keeps UIDVALIDITY and UIDNEXT of indexed messages.
+    """
+    return delta
 
 
 def box_key(box=None, tag=None):
@@ -90,6 +95,47 @@ def client(tag=None, box=None, writable=False, readonly=True):
     return ctx
 
 
+@local.using(local.SRC)
+def uids_by_sha256(hashes, con=None):
+    """Uids of existing messages by their hashes
+
+    Only headers of messages appended since the last call are fetched
+    to update the index, so the check is cheap for each batch.
+    """
+    index = data_sha256.get()
+    uidvalidity, uidnext = index.get('uidnext', (None, 1))
+    if uidvalidity != con.uidvalidity:
+        log.info('sha256: index is built from scratch')
+        data_sha256.unset()
+        index, uidnext = {}, 1
+
+    delta = {}
+    res = con.fetch('%s:*' % uidnext, 'BODY.PEEK[HEADER.FIELDS (X-SHA256)]')
+    for i in range(0, len(res), 2):
+        uid = res[i][0].decode().split()[2]
+        line = res[i][1].strip()
+        if int(uid) < uidnext or not line:
+            continue
+        hash = email.message_from_bytes(line)['X-SHA256'].strip()
+        delta[hash.strip('<>')] = uid
+    if delta:
+        uidnext = max(int(i) for i in delta.values()) + 1
+        delta['uidnext'] = [con.uidvalidity, uidnext]
+        data_sha256(delta)
+
+    found = {}
+    for hash in hashes:
+        uid = delta.get(hash) or index.get(hash)
+        if uid:
+            found[hash] = uid
+    if not found:
+        return {}
+
+    # messages could be expunged after indexing
+    uids = set(con.search('UID %s' % ','.join(found.values())))
+    return {hash: uid for hash, uid in found.items() if uid in uids}
+
+
 @local.using(local.SRC)
 def fetch_imap(uids, box, tag=None, con=None):
     map_tags = {
@@ -98,15 +144,6 @@ def fetch_imap(uids, box, tag=None, con=None):
         '\\Trash': '#trash',
         '\\Sent': '#sent',
     }
-    exists = {}
-    res = con.fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-SHA256)]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        line = res[i][1].strip()
-        if not line:
-            continue
-        hash = email.message_from_bytes(line)['X-SHA256'].strip()
-        exists[hash.strip('<>')] = uid
 
     def msgs(con):
         account = data_account.get()
@@ -114,8 +151,6 @@ def fetch_imap(uids, box, tag=None, con=None):
         for i in range(0, len(res), 2):
             line, raw = res[i]
             hash = hashlib.sha256(raw).hexdigest()
-            if hash in exists:
-                continue
             parts = re.search(
                 r'('
                 r'UID (?P<uid>\d+)'
@@ -142,10 +177,12 @@ def fetch_imap(uids, box, tag=None, con=None):
             headers = '\r\n'.join(headers)
 
             raw = headers.encode() + raw
-            yield parts['time'], flags, raw
+            yield hash, parts['time'], flags, raw
 
     with client(box=box, tag=tag) as c:
         msgs = list(msgs(c))
+    exists = uids_by_sha256([i[0] for i in msgs], con=con)
+    msgs = [i[1:] for i in msgs if i[0] not in exists]
     if not msgs:
         return None
 
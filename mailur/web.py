@@ -263,20 +263,56 @@ def filters():
     run()
 
 
+def cursors():
+    return URLSafeSerializer(conf['SECRET'], salt='search-cursor')
+
+
 @app.post('/search')
 @endpoint
 def search():
-    preload = request.json.get('preload')
-    q, opts = parse_query(request.json['q'])
+    """Found messages or threads
+
+    With "limit" only the first page is returned with "total" count and
+    "cursor", which is sent back instead of "q" for the next page.
+    """
+    data = schema.validate(request.json, {
+        'type': 'object',
+        'properties': {
+            'q': {'type': 'string'},
+            'limit': {'type': 'integer', 'minimum': 1},
+            'cursor': {'type': 'string'},
+        },
+        'anyOf': [{'required': ['q']}, {'required': ['cursor']}]
+    })
+    preload = data.get('preload')
+    limit = data.get('limit')
+    offset = 0
+    if data.get('cursor'):
+        try:
+            query, offset, limit = cursors().loads(data['cursor'])
+        except (BadSignature, BadData):
+            abort(400, 'Invalid cursor')
+    else:
+        query = data['q']
+
+    q, opts = parse_query(query)
     if opts.get('thread'):
         return thread(q, opts, preload)
 
+    total = None
     if opts.get('threads'):
-        uids = local.search_thrs(opts.get('parts', q))
+        parts = opts.get('parts', q)
+        if limit:
+            uids, total = local.search_thrs_page(parts, limit, offset)
+        else:
+            uids = local.search_thrs(parts)
         info = ft.partial(local.thrs_info, tags=opts.get('tags'))
         info_url = app.get_url('thrs_info')
     else:
-        uids = local.search_msgs(q)
+        if limit:
+            uids, total = local.search_msgs_page(q, limit, offset)
+        else:
+            uids = local.search_msgs(q)
         info = local.msgs_info
         info_url = app.get_url('msgs_info')
 
@@ -290,11 +326,18 @@ def search():
         'threads': opts.get('threads', False),
         'tags': tags
     }
-    return dict({
+    res = dict({
         'uids': uids,
         'msgs': msgs,
         'msgs_info': info_url
     }, **{k: v for k, v in extra.items() if v})
+    if limit:
+        offset += len(uids)
+        res['total'] = total
+        res['cursor'] = (
+            cursors().dumps([query, offset, limit]) if offset < total else None
+        )
+    return res
 
 
 @app.post('/thrs/info', name='thrs_info')
@@ -831,8 +874,8 @@ def compose(draft_id):
         to = [a['title'] for a in to_all]
         if not to:
             to = [to_all[0]['title']]
-        msgs = local.data_msgs.get()
-        refs = [i for i in [msgs[parent].get('parent'), meta['msgid']] if i]
+        parent_info = local.data_msgs.key(parent, {})
+        refs = [i for i in [parent_info.get('parent'), meta['msgid']] if i]
         defaults.update({
             'subject': subj,
             'to': '' if forward else ', '.join(to),
@@ -997,12 +1040,7 @@ def wrap_msgs(items, hide_tags=None):
     elif '#spam' in hide_tags:
         base_q = 'tag:#spam '
 
-    mids = local.data_msgids.get()
-    linked_uids = (
-        sum((mids.get(mid, []) for mid in link), [])
-        for link in local.data_links.get()
-    )
-    linked_uids = sum(linked_uids, [])
+    links = local.links_get()
 
     timezone = request.session['timezone']
     msgs = {}
@@ -1018,7 +1056,7 @@ def wrap_msgs(items, hide_tags=None):
             'is_unread': '\\Seen' not in flags,
             'is_pinned': '\\Flagged' in flags,
             'is_draft': '\\Draft' in flags,
-            'is_link': uid in linked_uids,
+            'is_link': local.links_find(links, info['msgid']) is not None,
         })
 
         if info['is_draft']:
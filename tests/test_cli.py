@@ -89,6 +89,12 @@ def test_fetch_and_parse(gm_client, login, msgs, patch, raises):
     cli.main('%s parse all' % login.user1)
     assert [i['uid'] for i in msgs(local.SRC)] == ['1', '2']
     assert [i['uid'] for i in msgs()] == ['3', '4']
+    cli.main('%s parse all --procs=2' % login.user1)
+    assert [i['uid'] for i in msgs(local.SRC)] == ['1', '2']
+    assert [i['uid'] for i in msgs()] == ['5', '6']
+    cli.main('%s parse all --max-inflight-mb=1' % login.user1)
+    assert [i['uid'] for i in msgs(local.SRC)] == ['1', '2']
+    assert [i['uid'] for i in msgs()] == ['7', '8']
 
     with patch('mailur.remote.fetch') as m, raises(SystemExit):
         m.side_effect = SystemExit
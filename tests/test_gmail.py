@@ -185,3 +185,27 @@ def test_unique(gm_client, msgs):
     gid = m['body']['X-GM-MSGID']
     gm_client.add_emails([{'gid': int(gid.strip('<>'))}], parse=False)
     assert [i['body']['X-GM-THRID'] for i in msgs(local.SRC)] == [gid]
+
+
+def test_uids_by_sha256(gm_client, msgs, patch):
+    gm_client.add_emails([{}, {}], parse=False)
+    hashes = [i['body']['X-SHA256'].strip('<>') for i in msgs(local.SRC)]
+    found = remote.uids_by_sha256(hashes + ['0' * 64])
+    assert found == {hashes[0]: '1', hashes[1]: '2'}
+    index = remote.data_sha256.get()
+    assert index['uidnext'][1] == 3
+    assert index[hashes[1]] == '2'
+
+    # only new messages are indexed
+    gm_client.add_emails([{}], parse=False)
+    hashes.append(msgs(local.SRC)[-1]['body']['X-SHA256'].strip('<>'))
+    with patch('mailur.remote.email.message_from_bytes') as m:
+        m.return_value = {'X-SHA256': '<%s>' % hashes[2]}
+        assert remote.uids_by_sha256(hashes[2:]) == {hashes[2]: '3'}
+        assert m.call_count == 1
+
+    # expunged messages aren't found
+    con = local.client(local.SRC, readonly=False)
+    con.store('1', '+FLAGS.SILENT', '\\Deleted')
+    con.expunge()
+    assert remote.uids_by_sha256(hashes) == {hashes[1]: '2', hashes[2]: '3'}
@@ -53,6 +53,42 @@ def test_fn_pack_uids():
     assert fn(['100', '1', '4', '3', '10', '9', '8', '7']) == '1,3:4,7:10,100'
 
 
+def test_fn_unpack_uids():
+    fn = imap.unpack_uids
+    assert fn('1:4') == ['1', '2', '3', '4']
+    assert fn('1,3:4') == ['1', '3', '4']
+    assert fn('1,3:4,7:10,100') == ['1', '3', '4', '7', '8', '9', '10', '100']
+    assert fn('5') == ['5']
+    assert fn('5:3,1') == ['5', '4', '3', '1']
+
+
+def test_fn_parse_esearch():
+    fn = imap.parse_esearch
+    line = b'(TAG "A1") UID PARTIAL (1:4 7,5:3) COUNT 10'
+    assert fn(line) == (['7', '5', '4', '3'], 10)
+    assert fn(b'(TAG "A1") UID PARTIAL (1:4 NIL) COUNT 0') == ([], 0)
+
+
+def test_metadata():
+    con = local.client(None)
+    con.setmetadata(local.SYS, {'mlr/a': '1 2', 'mlr/b/c': 'with "quotes"'})
+    assert con.getmetadata(local.SYS, 'mlr/a') == {'/private/mlr/a': '1 2'}
+    assert con.getmetadata(local.SYS, 'mlr', depth='infinity') == {
+        '/private/mlr/a': '1 2',
+        '/private/mlr/b/c': 'with "quotes"',
+    }
+    con.setmetadata(local.SYS, 'mlr/a', None)
+    assert '/private/mlr/a' not in con.getmetadata(
+        local.SYS, 'mlr', depth='infinity'
+    )
+
+    fn = imap.parse_metadata
+    assert fn([
+        (b'mlr/Sys (/private/a {3}', b'1 2'),
+        b' /private/b "\\"q\\"" /private/c NIL)'
+    ]) == {'/private/a': '1 2', '/private/b': '"q"', '/private/c': None}
+
+
 def test_literal_size_limit(gm_client, raises):
     # for query like "UID 1,2,...,150000" should be big enough
     gm_client.add_emails([{} for i in range(0, 20)], parse=False)
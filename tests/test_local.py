@@ -1,4 +1,4 @@
-from mailur import local
+from mailur import cache, local, lock, message
 
 
 def test_uidpairs(gm_client, msgs, patch, call):
@@ -32,16 +32,16 @@ def test_uidpairs(gm_client, msgs, patch, call):
     local.data_uidpairs.get()
     local.data_threads.get()
     local.data_msgids.get()
+    local.data_refs.get()
     settings = local.data_settings.get()
     with patch('imaplib.IMAP4.uid') as m:
         m.return_value = 'OK', []
         local.update_metadata('4')
         assert m.called
-        assert m.call_args_list == [
-            call('FETCH', '4', '(FLAGS BINARY.PEEK[1])'),
-            call('FETCH', '1:*', '(UID BODY[HEADER.FIELDS (Subject)])'),
-            call('THREAD', 'REFS UTF-8 INTHREAD REFS UID 4'),
-        ]
+        assert m.call_args_list == [call(
+            'FETCH', '4',
+            '(FLAGS BINARY.PEEK[1] BODY.PEEK[HEADER.FIELDS (References)])'
+        )]
     local.data_settings(settings)
 
     patched = {'wraps': local.update_metadata}
@@ -65,6 +65,298 @@ def test_uidpairs(gm_client, msgs, patch, call):
         assert m.call_args == call('9:*')
 
 
+def test_parse_cache(gm_client, msgs, patch, tmpdir):
+    with patch.dict('mailur.conf', {'CACHE_DIR': str(tmpdir)}):
+        gm_client.add_emails([{'from': 'a@t.com'}, {}])
+        parsed = [i['body'] for i in msgs(raw=True)]
+
+        with patch('mailur.message.parsed') as m:
+            local.parse('all')
+            assert not m.called
+        assert [i['uid'] for i in msgs()] == ['3', '4']
+        assert [i['body'] for i in msgs(raw=True)] == parsed
+
+        # a new charsets hint of the sender is a part of the key
+        local.data_charsets({'a@t.com': 'koi8-r'})
+        with patch('mailur.message.parsed', wraps=message.parsed) as m:
+            local.parse('all')
+            assert m.call_count == 1
+
+        with patch('mailur.message.VERSION', message.VERSION + 1):
+            with patch('mailur.message.parsed', wraps=message.parsed) as m:
+                local.parse('all')
+                assert m.call_count == 2
+
+        # results of previous versions are removed
+        path = tmpdir / local.conf['USER'] / 'parsed'
+        assert sorted(i.basename for i in path.listdir()) == [
+            'v%s' % (message.VERSION + 1)
+        ]
+        local.parse()
+        assert path.listdir() == []
+
+
+def test_parse_stale(gm_client, msgs, patch):
+    gm_client.add_emails([{}, {}])
+    local.parse_stale()
+    assert [i['uid'] for i in msgs()] == ['1', '2']
+
+    version = message.VERSION + 1
+    with patch('mailur.message.VERSION', version):
+        local.parse_stale(batch=1)
+    assert [i['uid'] for i in msgs()] == ['3', '4']
+    assert local.data_uidpairs.get() == {'1': '3', '2': '4'}
+    assert local.data_threads.get()[1] == {'3': ['3'], '4': ['4']}
+    assert msgs(parsed=True)[0]['meta']['parser_version'] == version
+    assert local.data_uidnext.get() == 3
+
+    # "uidnext" is moved only by parsing of new messages
+    gm_client.add_emails([{}], parse=False)
+    local.parse('UID 1')
+    assert local.data_uidnext.get() == 3
+    local.parse()
+    assert local.data_uidnext.get() == 4
+
+
+def test_metadata_journal(gm_client):
+    gm_client.add_emails([{}])
+    assert local.metadata_uids()['msgs:0'] == ['1']
+
+    gm_client.add_emails([{}, {}])
+    uids = local.metadata_uids()['msgs:0']
+    assert len(uids) == 2
+    msgs = local.data_msgs.get()
+    assert sorted(msgs) == ['1', '2', '3']
+
+    # other processes replay the journal on top of the snapshot
+    cache.clear()
+    assert local.data_msgs.get() == msgs
+    assert local.metadata_uids()['msgs:0'] == uids
+
+    local.data_msgs.update({'2': None})
+    assert sorted(local.data_msgs.get()) == ['1', '3']
+    assert len(local.metadata_uids()['msgs:0']) == 3
+    cache.clear()
+    assert sorted(local.data_msgs.get()) == ['1', '3']
+
+    # the journal is folded into new snapshot
+    for i in range(100):
+        local.data_msgs.update({'2': {'num': i}})
+    uids = local.metadata_uids()['msgs:0']
+    assert len(uids) == 2
+    cache.clear()
+    assert local.data_msgs.get()['2'] == {'num': 99}
+    assert local.metadata_uids()['msgs:0'] == uids
+
+
+def test_metadata_shards(gm_client):
+    gm_client.add_emails([{}, {}])
+    assert 'msgs:0' in local.metadata_uids()
+    assert 'msgs' not in local.metadata_uids()
+    msgs = local.data_msgs.get()
+    local.data_msgs.update({'20001': {'msgid': '<x>'}})
+    assert 'msgs:2' in local.metadata_uids()
+    # merged value isn't copied for every delta, it's rebuilt lazily
+    assert not cache.exists('metadata:msgs:all')
+    assert local.data_msgs.key('20001') == {'msgid': '<x>'}
+    assert local.data_msgs.key('1') == msgs['1']
+    assert local.data_msgs.many(['20001', '1', '3']) == {
+        '20001': {'msgid': '<x>'}, '1': msgs['1']
+    }
+
+    # only needed shards are loaded
+    cache.clear()
+    local.data_msgs.many(['20001'])
+    assert not cache.exists('metadata:msgs:0')
+    assert cache.exists('metadata:msgs:2')
+
+    # only changed shards are saved
+    local.data_msgs(dict(msgs, **{'20001': {}}))
+    uids = local.metadata_uids()
+    local.data_msgs(dict(msgs, **{'20001': {'msgid': '<y>'}}))
+    assert local.metadata_uids()['msgs:0'] == uids['msgs:0']
+    assert local.metadata_uids()['msgs:2'] != uids['msgs:2']
+    cache.clear()
+    assert local.data_msgs.get() == dict(msgs, **{'20001': {'msgid': '<y>'}})
+
+    # merged value is counted as big as all shards
+    sizes = [cache.get('metadata:msgs:%s' % i)[3] for i in (0, 2)]
+    assert cache.sizes[cache.key('metadata:msgs:all')] == sum(sizes)
+
+
+def test_metadata_shared_cache(gm_client, patch, tmpdir):
+    with patch.dict('mailur.conf', {'CACHE_DIR': str(tmpdir)}):
+        gm_client.add_emails([{}, {}])
+        cache.clear()
+        msgs = local.data_msgs.get()
+        assert cache.shared_get('metadata:msgs:0')[1] == msgs
+
+        # fresh value from the process isn't read from the shared file
+        with patch('mailur.cache.shared_get') as m:
+            assert local.data_msgs.many(['1']) == {'1': msgs['1']}
+            assert not m.called
+
+        # another process takes the value from the shared file
+        cache.rm('metadata:msgs:0')
+        cache.rm('metadata:msgs:all')
+        with patch('imaplib.IMAP4.uid') as m:
+            assert local.data_msgs.get() == msgs
+            assert not m.called
+
+    assert cache.shared_get('metadata:msgs:0') is None
+
+
+def test_metadata_index(gm_client, patch):
+    gm_client.add_emails([{}])
+    uids = local.metadata_uids()
+    con = local.client(None)
+    index = con.getmetadata(local.SYS, 'mlr', depth='infinity')
+    assert index['/private/mlr/doc/msgs:0'] == ' '.join(uids['msgs:0'])
+
+    # no scan of SYS folder if index is consistent
+    cache.clear()
+    with patch('imaplib.IMAP4.uid') as m:
+        assert local.metadata_uids() == uids
+        assert not m.called
+
+    # index is rebuilt after foreign APPEND
+    msg = message.binary('{}')
+    msg.add_header('Subject', 'other')
+    con.append(local.SYS, None, None, msg.as_bytes())
+    cache.clear()
+    uids = local.metadata_uids()
+    assert 'other' in uids
+    cache.clear()
+    with patch('imaplib.IMAP4.uid') as m:
+        assert local.metadata_uids() == uids
+        assert not m.called
+
+    # superseded messages are expunged by batches
+    for i in range(101):
+        local.data_modseq(i)
+    index = con.getmetadata(local.SYS, 'mlr', depth='infinity')
+    assert len(index.get('/private/mlr/clean', '').split()) < 100
+    con.select(local.SYS)
+    assert len(con.search('ALL')) < 100
+    assert local.data_modseq.get() == 100
+
+
+def test_metadata_view(gm_client, raises):
+    gm_client.add_emails([{}])
+    msgs = local.data_msgs.get()
+    with raises(TypeError):
+        msgs['2'] = {}
+
+    msgs = local.data_msgs.edit()
+    msgs['2'] = {}
+    assert '2' not in local.data_msgs.get()
+
+    thrids, thrs = local.data_threads.get()
+    with raises(TypeError):
+        thrids['2'] = '2'
+    thrids, thrs = local.data_threads.edit()
+    thrids['2'] = '2'
+    assert '2' not in local.data_threads.get()[0]
+
+    local.data_tags({'#a': {'name': 'a'}})
+    tags = local.data_tags.get()
+    with raises(TypeError):
+        tags['#b'] = {}
+    tags = local.data_tags.edit()
+    tags['#b'] = {}
+    assert '#b' not in local.data_tags.get()
+
+
+def test_metadata_txn(gm_client, patch, raises):
+    gm_client.add_emails([{}])
+    msgs = dict(local.data_msgs.get())
+    with patch('imaplib.IMAP4.append') as m:
+        with local.metadata_txn():
+            local.data_msgs.update({'2': {'msgid': '<2>'}})
+            local.data_uidpairs.update({'2': '2'})
+            local.data_msgs.update({'20001': {'msgid': '<3>'}})
+            assert local.data_msgs.key('2') == {'msgid': '<2>'}
+            assert local.data_uidpairs.key('2') == '2'
+        assert not m.called
+
+    msgs.update({'2': {'msgid': '<2>'}, '20001': {'msgid': '<3>'}})
+    assert local.data_msgs.get() == msgs
+    cache.clear()
+    assert local.data_msgs.get() == msgs
+    assert local.data_uidpairs.key('2') == '2'
+
+    # locks are held till the commit
+    with local.metadata_txn():
+        local.data_msgs.update({'2': None})
+        with raises(lock.Error):
+            with lock.user_scope('msgs', wait=1):
+                pass
+    with lock.user_scope('msgs', wait=1):
+        pass
+
+
+def test_settings():
+    # values from the old "settings" document are still used
+    local.data_settings({'tags': {'#a': {'name': 'a'}}})
+    assert local.data_tags.get() == {'#a': {'name': 'a'}}
+
+    local.data_tags({'#b': {'name': 'b'}})
+    local.data_drafts({'<1>': {'txt': '1'}})
+    local.data_drafts({'<2>': {'txt': '2'}})
+    local.data_drafts({'<1>': None})
+    uids = local.metadata_uids()
+    assert len(uids['settings/tags']) == 1
+    assert len(uids['settings/drafts']) == 3
+    assert uids['settings'] == local.metadata_uids()['settings']
+
+    cache.clear()
+    assert local.data_drafts.get() == {'<2>': {'txt': '2'}}
+    assert local.data_tags.get() == {
+        '#a': {'name': 'a'}, '#b': {'name': 'b'}
+    }
+
+    local.data_tags.unset()
+    assert local.data_tags.get() == {}
+
+
+def test_cache_lru(patch):
+    cache.clear()
+    with patch.dict('mailur.conf', {'CACHE_MB': 1}):
+        stats = dict(cache.usage())
+        cache.set('one', 1, size=2 ** 19)
+        cache.set('two', 2, size=2 ** 19)
+        assert cache.get('one') == 1
+        cache.set('three', 3, size=2 ** 19)
+        assert not cache.exists('two')
+        assert cache.get('two') is None
+        assert cache.get('one') == 1
+        assert cache.get('three') == 3
+
+        usage = cache.usage()
+        assert usage['hits'] - stats['hits'] == 3
+        assert usage['misses'] - stats['misses'] == 1
+        assert usage['evictions'] - stats['evictions'] == 1
+        assert usage['users'][local.conf['USER']] == 2 ** 20
+
+        # too big value is cached anyway
+        cache.set('four', 4, size=2 ** 21)
+        assert cache.get('four') == 4
+        assert not cache.exists('one')
+    cache.clear()
+
+
+def test_msgs_body_cache(gm_client, patch):
+    gm_client.add_emails([{}])
+    body = dict(local.msgs_body(['1'], True))
+    with patch('mailur.html.fix_privacy') as m:
+        assert dict(local.msgs_body(['1'], True)) == body
+        assert not m.called
+
+        m.return_value = 'proxied'
+        assert dict(local.msgs_body(['1'])) == {'1': 'proxied'}
+        assert m.called
+
+
 def test_update_metadata(gm_client, msgs, patch, call):
     gm_client.add_emails([{}, {}])
     assert ['1', '2'] == [i['uid'] for i in msgs(local.SRC)]
@@ -154,6 +446,94 @@ def test_data_threads(gm_client):
     assert local.search_thrs('all') == ['15', '14', '13', '11']
 
 
+def test_threads_graph(gm_client, patch):
+    patched = {'wraps': local.rebuild_threads}
+    with patch('mailur.local.rebuild_threads', **patched) as m:
+        gm_client.add_emails([{}])
+        assert m.called
+
+        m.reset_mock()
+        gm_client.add_emails([
+            {'in_reply_to': '<101@mlr>'},
+            {'refs': '<non-exist@mlr>'},
+            {'refs': '<non-exist@mlr> <101@mlr>'}
+        ])
+        assert not m.called
+    assert local.data_threads.get()[1] == {
+        '3': ['3'],
+        '4': ['1', '2', '4']
+    }
+    assert list(local.data_recency.get().latest()) == ['4', '3']
+    assert local.search_thrs('all', limit=1) == ['4']
+
+    # stale index of the same size falls back to sorting by arrival
+    local.data_recency({'4': 1, '5': 2})
+    assert local.thrs_latest(['3', '4']) == ['4', '3']
+    assert local.thrs_latest(['3', '4'], limit=1) == ['4']
+    # ties are ordered by uid like in the index
+    with patch('mailur.local.data_msgs.many') as m:
+        m.return_value = {'3': {'arrived': 1}, '4': {'arrived': 1}}
+        assert local.thrs_arrived(['3', '4']) == ['4', '3']
+
+    # messages without "Message-ID" aren't joined by it
+    def raw(refs):
+        return '\r\n'.join([
+            'From: a@t.com', 'Subject: no id', 'References: %s' % refs,
+            '', '42'
+        ]).encode()
+
+    gm_client.add_emails([{'raw': raw('<104@mlr>')}])
+    gm_client.add_emails([{'raw': raw('<103@mlr>')}])
+    thrs = {'5': ['1', '2', '4', '5'], '6': ['3', '6']}
+    assert local.data_threads.get()[1] == thrs
+    local.update_threads('1:*')
+    assert local.data_threads.get()[1] == thrs
+
+    refs = {}
+    local.refs_link(refs, ['<a>', '<b>', '<c>'])
+    local.refs_link(refs, ['<x>', '<b>', '<d>'])
+    assert refs == {'<b>': '<a>', '<c>': '<b>', '<d>': '<b>'}
+    assert local.refs_root(refs, '<d>') == '<a>'
+    # no loops
+    local.refs_link(refs, ['<c>', '<a>'])
+    assert '<a>' not in refs
+
+
+def test_tags_counts(gm_client, patch):
+    gm_client.add_emails([{'labels': '#test'}, {'in_reply_to': '<101@mlr>'}])
+    tags = local.tags_info()
+    assert tags['#test']['unread'] == 2
+    assert tags['#unread']['unread'] == 2
+    assert local.data_tagcounts.get()['tags'] == {'#test': [1, 2]}
+
+    with patch('mailur.local.update_tagcounts') as m:
+        local.tags_info()
+        assert not m.called
+
+    local.msgs_flag(['2'], [], ['\\Seen'])
+    tags = local.tags_info()
+    assert tags['#test']['unread'] == 1
+    assert tags['#unread']['unread'] == 1
+    assert local.data_tagthrs.get() == {'2': [1, ['#test']]}
+
+
+def test_links():
+    links = {}
+    local.links_union(links, ['<a>', '<b>'])
+    local.links_union(links, ['<c>'])
+    assert local.links_find(links, '<a>') == local.links_find(links, '<b>')
+    assert local.links_find(links, '<c>') == '<c>'
+    assert local.links_find(links, '<x>') is None
+
+    local.links_union(links, ['<b>', '<c>'])
+    root = local.links_find(links, '<c>')
+    assert sorted(links[root]) == ['<a>', '<b>', '<c>']
+    assert set(local.links_find(links, i) for i in links) == {root}
+
+    local.links_unlink(links, ['<a>'])
+    assert [local.links_find(links, i) for i in links] == [None] * 3
+
+
 def test_link_threads_part1(gm_client, msgs):
     gm_client.add_emails([{}, {}])
     refs = [
@@ -1,8 +1,12 @@
 import re
+from email import message_from_bytes
 from email.message import MIMEPart
 
-from mailur import local
-from mailur.message import addresses, binary
+from mailur import html, local
+from mailur.message import (
+    addresses, binary, decoded_size, detect_charset, from_bytes, parsed,
+    sender
+)
 
 
 def test_binary():
@@ -24,6 +28,35 @@ def test_binary():
     ])
 
 
+def test_decoded_size():
+    for data in (b'', b'1', b'12', b'123', bytes(range(256)) * 50):
+        for cte in ('base64', 'quoted-printable', '7bit'):
+            if cte == '7bit':
+                data = data.decode('latin1').encode('ascii', 'replace')
+            part = MIMEPart()
+            part.set_content(data, 'application', 'octet-stream', cte=cte)
+            assert decoded_size(part) == len(part.get_payload(decode=True))
+
+    part = binary('Ответ: 42')
+    assert decoded_size(part) == len('Ответ: 42'.encode())
+
+
+def test_from_bytes(load_file, patch):
+    def parsed_msg(raw):
+        msg = parsed(raw, '1', '"07-Jan-2015 13:23:22 +0000"', [])[0]
+        # boundaries are random
+        return re.sub(rb'={15}\d+==', b'', msg.as_bytes())
+
+    for name in ('msg-attachments-two-gmail.txt', 'msg-embeds-one-gmail.txt'):
+        raw = load_file(name)
+        expected = parsed_msg(raw)
+        with patch.multiple('mailur.message', STREAM_SIZE=0, SPILL_SIZE=10):
+            msg = from_bytes(raw)
+            assert any(getattr(i, 'spilled', None) for i in msg.walk())
+            assert msg.as_bytes() == message_from_bytes(raw).as_bytes()
+            assert parsed_msg(raw) == expected
+
+
 def test_general(gm_client, load_file, latest, load_email):
     gm_client.add_emails([{'flags': '\\Flagged'}])
     msg = latest()
@@ -236,6 +269,28 @@ def test_richer(gm_client, latest, login):
     assert 'data-style="color:red"' in body
 
 
+def test_html_parsed_once(patch):
+    raw = '\r\n'.join([
+        'From: katya@example.com',
+        'Message-ID: <html-once@test>',
+        'Content-type: text/html; charset=utf-8',
+        '',
+        '<p>test <b>html</b></p>',
+    ])
+    time = '"07-Jan-2015 13:23:22 +0000"'
+    with patch('mailur.html.fromstring', wraps=html.fromstring) as m:
+        parsed(raw.encode(), '1', time, [])
+        assert m.call_count == 1
+
+        m.reset_mock()
+        htm = '<p>test <b>html</b></p>'
+        assert html.fix_privacy(htm, cleaned=True) == htm
+        assert not m.called
+        htm = '<p style="color:red">test html</p>'
+        assert 'data-style' in html.fix_privacy(htm, cleaned=True)
+        assert m.call_count == 1
+
+
 def test_encodings(gm_client, load_email):
     m = load_email('msg-encoding-empty-charset.txt', parsed=True)
     assert m['body'] == '<p>test</p>'
@@ -264,6 +319,37 @@ def test_encodings(gm_client, load_email):
     assert m['meta']['subject'] == 'Оплатите, пожалуйста, счет'
 
 
+def test_detect_charset(gm_client, load_file, latest):
+    assert detect_charset('тест'.encode()) == ('utf8', 'utf-8')
+    raw = 'тест'.encode('cp1251')
+    assert detect_charset(raw) == ('chardet', 'windows-1251')
+    # chardet only guesses for so short text
+    assert detect_charset(raw, ['koi8-r']) == ('hints', 'koi8-r')
+
+    raw = 'Привет, как дела? Это тестовое сообщение.'.encode('cp1251')
+    assert detect_charset(raw, ['koi8-r']) == ('chardet', 'windows-1251')
+    # a tie with another candidate is broken by the hint
+    assert detect_charset(raw, ['mac-cyrillic']) == ('hints', 'mac-cyrillic')
+
+    raw = load_file('msg-encoding-cp1251-chardet.txt', 'cp1251')
+    gm_client.add_emails([{'raw': raw}])
+    m = latest(parsed=True)
+    assert m['meta']['detected'] == [['chardet', 'windows-1251']]
+    assert local.data_charsets.get() == {
+        'sales@hostpro.com.ua': 'windows-1251',
+    }
+
+    # learned charset is used for the next message of the sender
+    gm_client.add_emails([{'raw': raw}])
+    m = latest(parsed=True)
+    assert m['meta']['detected'] == [['hints', 'windows-1251']]
+    assert local.data_charsets_detected.get() == {'chardet': 1, 'hints': 1}
+
+    # only headers are parsed to get the sender
+    assert sender(raw) == 'sales@hostpro.com.ua'
+    assert sender(b'From: X <x@T.com>\r\n\r\nFrom: y@t.com') == 'x@t.com'
+
+
 def test_addresses():
     res = addresses('test <test@example.com>')
     assert res == [{
@@ -552,7 +638,7 @@ def test_parts(gm_client, latest, load_email):
         {
             'filename': 'unknown-2.eml',
             'path': '2',
-            'size': 463,
+            'size': 462,
             'url': '/raw/20/2/unknown-2.eml',
         }
     ]
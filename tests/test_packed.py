@@ -0,0 +1,88 @@
+from mailur import packed
+
+
+def test_uidmap():
+    m = packed.UidMap({'10': '1', '2': '2'})
+    assert list(m) == ['2', '10']
+    assert m == {'2': '2', '10': '1'}
+    assert m['10'] == '1'
+    assert m.get(None) is None
+    assert 'x' not in m
+
+    m['5'] = '10'
+    del m['2']
+    assert m.pop('10') == '1'
+    assert m == {'5': '10'}
+
+    m.update({'20': '20', '1': '1'})
+    assert list(m.items()) == [('1', '1'), ('5', '10'), ('20', '20')]
+
+
+def test_uidlists():
+    m = packed.UidLists({'2': ['1', '2'], '10': ['10']})
+    assert m == {'2': ['1', '2'], '10': ['10']}
+
+    m['3'] = ['3']
+    del m['10']
+    assert len(m) == 2
+    assert sorted(m) == ['2', '3']
+    m.compact()
+    assert m == {'2': ['1', '2'], '3': ['3']}
+
+    # merging of shards
+    m.update(packed.UidLists({'10000': ['10001', '10000']}))
+    assert m['10000'] == ['10001', '10000']
+    assert len(m) == 3
+
+
+def test_copy_and_view():
+    m = packed.UidLists({'2': ['1', '2']})
+    c = m.copy()
+    c['3'] = ['3']
+    assert m == {'2': ['1', '2']}
+
+    m = packed.UidMap({'1': '1'})
+    c = m.copy()
+    c['2'] = '2'
+    assert m == {'1': '1'}
+
+    view = packed.View(m)
+    assert view == {'1': '1'}
+    assert not hasattr(view, '__setitem__')
+
+
+def test_uidtimes():
+    m = packed.UidTimes({'1': 20, '2': 10, '3': 20})
+    assert list(m.latest()) == ['3', '1', '2']
+    assert m['2'] == 10
+
+    m['2'] = 30
+    del m['3']
+    assert list(m.latest()) == ['2', '1']
+    assert m == {'1': 20, '2': 30}
+
+    codec = packed.Codec(packed.UidTimes)
+    m = codec.loads(codec.dumps(m))
+    assert list(m.latest()) == ['2', '1']
+    assert list(packed.View(m).latest()) == ['2', '1']
+
+
+def test_codec():
+    codec = packed.Codec(packed.UidMap, packed.UidLists)
+    thrids, thrs = codec()
+    assert thrids == {} and thrs == {}
+
+    value = [{'1': '2', '2': '2'}, {'2': ['1', '2']}]
+    data = codec.dumps(value)
+    assert data.startswith(packed.MAGIC)
+    thrids, thrs = codec.loads(data)
+    assert isinstance(thrids, packed.UidMap)
+    assert [thrids, thrs] == value
+
+    # saved as JSON before
+    assert codec.loads(b'[{"1": "1"}, {"1": ["1"]}]') == [
+        {'1': '1'}, {'1': ['1']}
+    ]
+
+    codec = packed.Codec(packed.UidMap)
+    assert codec.loads(codec.dumps({'3': '4'})) == {'3': '4'}
@@ -109,6 +109,33 @@ def test_tz(gm_client, web, login, some):
     assert some['time_title'] == time_2h.strftime('%a, %d %b, %Y at %H:%M')
 
 
+def test_search_pages(gm_client, login):
+    gm_client.add_emails([{} for i in range(5)])
+    web = login()
+    res = web.search({'q': '', 'limit': 2, 'preload': 1})
+    assert res['uids'] == ['5', '4']
+    assert res['total'] == 5
+    assert list(res['msgs']) == ['5']
+    res = web.search({'cursor': res['cursor']})
+    assert res['uids'] == ['3', '2']
+    res = web.search({'cursor': res['cursor']})
+    assert res['uids'] == ['1']
+    assert res['cursor'] is None
+
+    res = web.search({'q': ':threads', 'limit': 3})
+    assert res['uids'] == ['5', '4', '3']
+    assert res['total'] == 5
+    res = web.search({'cursor': res['cursor']})
+    assert res['uids'] == ['2', '1']
+    assert res['cursor'] is None
+
+    web.search({'cursor': 'wrong'}, status=400)
+    web.search({'q': ':threads', 'limit': 0}, status=400)
+    web.search({'q': ':threads', 'limit': '3'}, status=400)
+    web.search({'cursor': 1}, status=400)
+    web.search({'limit': 3}, status=400)
+
+
 def test_tags(gm_client, login, some, load_file):
     def query(tag):
         if tag == ':all':
@@ -348,6 +375,7 @@ def test_general(gm_client, load_email, latest, login, some):
                 'msgid': '<101@mlr>',
                 'origin_uid': '1',
                 'parent': None,
+                'parser_version': 3,
                 'preview': '42',
                 'query_msgid': 'ref:<101@mlr>',
                 'query_subject': ':threads subj:"Subj 101"',
@@ -375,6 +403,7 @@ def test_general(gm_client, load_email, latest, login, some):
                 'msgid': '<102@mlr>',
                 'origin_uid': '2',
                 'parent': '<101@mlr>',
+                'parser_version': 3,
                 'preview': '42',
                 'query_msgid': 'ref:<102@mlr>',
                 'query_subject': ':threads subj:"Subj 102"',
@@ -417,6 +446,7 @@ def test_general(gm_client, load_email, latest, login, some):
                 'msgid': '<102@mlr>',
                 'origin_uid': '2',
                 'parent': '<101@mlr>',
+                'parser_version': 3,
                 'preview': '42',
                 'query_msgid': 'ref:<102@mlr>',
                 'query_subject': ':threads subj:"Subj 102"',
@@ -1279,7 +1309,7 @@ def test_drafts_sending(gm_client, login, sendmail, patch, some, latest):
         'time': some,
     }
     assert local.data_drafts.get() == {draft_id: some}
-    assert m['body_full'].as_string().split('\n')[:11] == [
+    assert m['body_full'].as_string().split('\n')[:12] == [
         'X-UID: <2>',
         'Message-ID: %s' % draft_id,
         'Subject: Re: Subj 101',
@@ -1289,6 +1319,7 @@ def test_drafts_sending(gm_client, login, sendmail, patch, some, latest):
         'X-Draft-ID: %s' % draft_id,
         'In-Reply-To: <101@mlr>',
         'References: <101@mlr>',
+        'X-Parser-Version: <3>',
         some,
         ''
     ]